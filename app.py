@@ -1,23 +1,64 @@
 import os
+
+# 'debug': threaded werkzeug server with debugger and reloader, for development
+# 'production': every request, loop and subprocess pipe runs in cooperative gevent greenlets
+server_mode = os.environ.get('SERVER_MODE', 'debug')
+
+# gevent has to patch the standard library (threading, subprocess, socket, time) before anything else imports it,
+# after that the blocking calls to bluetoothctl and amixer only block their own greenlet
+if server_mode == 'production':
+    from gevent import monkey
+    monkey.patch_all()
+
 import sys
 import time
 import json
 import uuid
 import logging
 import subprocess
-from threading import Thread, Event
+from threading import Event
 
-import obd
 from flask_cors import CORS
 from flask_socketio import SocketIO
-from flask import Flask, request
+from flask import Flask, request, g
 
-from bluetooth import Bluetooth
+from bluetooth import Bluetooth, BluetoothctlNotFoundException
+from bluetoothctl_session import BluetoothctlTimeoutException, BluetoothctlSessionClosedException
+import player
 from player import PlayerNotFoundException
+from telemetry import TelemetryAggregator
+from telemetry_history import TelemetryHistory
+from trip_recorder import TripRecorder
+from derived_metrics import DerivedMetrics, load_derived_config
+from smoothing import load_smoothing_config
+from obd_scheduler import load_watched_commands
+from telemetry_source import TelemetrySource, ObdSource, SyntheticSource, ReplaySource, MissingReplayPathException
+from obd_worker import ObdWorkerSource
+from readiness import Readiness, READY, FAILED
+from metrics import registry
+from subscriptions import Subscriptions
+from state_store import StateStore
+from outbound import OutboundQueues
 
 flask_secret_key = os.environ.get('FLASK_SECRET_KEY', str(uuid.uuid4()))
-dashboard_update_time = os.environ.get('DASHBOARD_UPDATE_TIME', '0.2')
+dashboard_update_time = float(os.environ.get('DASHBOARD_UPDATE_TIME', '0.2'))
 obd_adapter_serial_name = os.environ.get('OBD_ADAPTER_SERIAL_NAME', 'serial')
+telemetry_source_name = os.environ.get('TELEMETRY_SOURCE', 'obd')
+obd_cache_path = os.environ.get('OBD_CACHE_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), '.obd_adapter.json'))
+obd_config_path = os.environ.get('OBD_CONFIG_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'obd_config.yaml'))
+player_dbus_bus = os.environ.get('PLAYER_DBUS_BUS', 'SYSTEM')
+bluetoothctl_path = os.environ.get('BLUETOOTHCTL_PATH', 'bluetoothctl')
+bluetooth_query_ttl = float(os.environ.get('BLUETOOTH_QUERY_TTL', '0.5'))
+player.amixer_module_path = os.environ.get('AMIXER_PATH', 'amixer')
+server_port = int(os.environ.get('SERVER_PORT', '3333'))
+server_debug = os.environ.get('SERVER_DEBUG', 'true') == 'true' and server_mode == 'debug'
+telemetry_history_size = int(os.environ.get('TELEMETRY_HISTORY_SIZE', '3000'))
+trip_recording = os.environ.get('TRIP_RECORDING', 'true') == 'true'
+trip_directory = os.environ.get('TRIP_DIRECTORY', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'trips'))
+metrics_log_interval = float(os.environ.get('METRICS_LOG_INTERVAL', '0'))
+derived_metrics_enabled = os.environ.get('DERIVED_METRICS', 'true') == 'true'
+# read the obd adapter (or the synthetic source) in a separate worker process
+obd_process = os.environ.get('OBD_PROCESS', 'false') == 'true'
 
 # Configure logging with a custom format
 log_formatter = logging.Formatter('[%(asctime)s] %(levelname)s: %(message)s', datefmt='%d/%b/%Y %H:%M:%S')
@@ -32,65 +73,297 @@ logger.setLevel(logging.DEBUG)
 app = Flask(__name__)
 CORS(app)
 app.config['SECRET_KEY'] = flask_secret_key
-socketio = SocketIO(app, cors_allowed_origins="*")
+socketio = SocketIO(app, cors_allowed_origins="*", async_mode='gevent' if server_mode == 'production' else 'threading')
 
-# create bluetooth instance to use bluetoothctl features
-bluetooth = Bluetooth(logger=logger)
+# metrics of the hot paths, exposed on /metrics
+samples_total = registry.counter('telemetry_samples_total', 'Samples received from the telemetry source, labeled by command.')
+sample_interval_seconds = registry.histogram('telemetry_sample_interval_seconds', 'Time between two samples of the same command, shows the rate and the jitter.')
+emit_seconds = registry.histogram('socketio_emit_seconds', 'Time spent in socketio.emit, labeled by event.')
+http_request_seconds = registry.histogram('http_request_seconds', 'Time spent handling a http request, labeled by endpoint.')
+http_requests_total = registry.counter('http_requests_total', 'Handled http requests, labeled by endpoint and status.')
+
+# timestamp of the last sample of every command, for the sample interval
+last_sample_times = dict()
+
+# channels the clients can subscribe to, every channel is sent as socket.io event with the same name
+subscriptions = Subscriptions(['telemetry', 'player_update', 'obd_status', 'obd_rates'])
+
+# latest data of every channel, sent to clients as snapshot when they connect
+state_store = StateStore()
+
+def send_to_client(sid: str, event: str, data: str):
+    """
+    Sends a message to one client and measures how long that took.
+    """
+
+    with emit_seconds.time(event=event):
+        socketio.emit(event, data, to=sid)
+
+def transport_backlog(sid: str) -> int:
+    """
+    Returns how many packets engine.io queued for the client `sid` but did not write yet. Returns 0 if it is not known.
+    """
+
+    try:
+        eio_sid = socketio.server.manager.eio_sid_from_sid(sid, '/')
+        return socketio.server.eio.sockets[eio_sid].queue.qsize()
+    except (AttributeError, KeyError, NotImplementedError):
+        return 0
+
+# every client has its own queue, so a client on a slow connection gets the latest telemetry instead of a growing backlog
+# telemetry frames contain all values, so only the latest frame is kept, all other channels are sent in order
+outbound = OutboundQueues(
+    send=send_to_client,
+    start_task=socketio.start_background_task,
+    backlog=transport_backlog,
+    latest_channels=['telemetry'],
+    max_events=int(os.environ.get('OUTBOUND_MAX_EVENTS', '50')),
+    max_backlog=int(os.environ.get('OUTBOUND_MAX_BACKLOG', '4')),
+    logger=logger,
+)
+
+def emit(channel: str, data: dict):
+    """
+    Stores `data` as the current state of `channel` and queues it as json for the clients subscribed to it.
+    Nothing is sent if nobody is subscribed, `data` is not even serialized then.
+    """
+
+    state_store.set(channel, data)
+
+    if not subscriptions.has_subscribers(channel): return
 
-# create connection to obd adapter
-obd_conn: obd.Async = None
+    outbound.send_to(subscriptions.subscribers(channel), channel, json.dumps(data))
+
+def emit_delta(channel: str, data: dict, skip: str = None) -> dict:
+    """
+    Merges `data` into the versioned state of `channel` and queues only the fields that changed for the clients subscribed to it (see StateStore).
+    Nothing is sent if nothing changed. Returns the delta, None if nothing changed.
+
+    :param skip: A client that is not sent the delta, because it gets the full state right after.
+    """
+
+    delta = state_store.update(channel, data)
+
+    if delta is None or not subscriptions.has_subscribers(channel): return delta
+
+    sids = [sid for sid in subscriptions.subscribers(channel) if sid != skip]
+
+    outbound.send_to(sids, channel, json.dumps(delta))
+
+    return delta
+
+# errors of bluetoothctl the player loop survives, the session is started again by the next command
+bluetoothctl_errors = (BluetoothctlTimeoutException, BluetoothctlSessionClosedException, BluetoothctlNotFoundException, BrokenPipeError)
+
+# Event that is set by the player when it reports a change over D-Bus
+player_changed_event = Event()
+
+# state of the subsystems that are started in the background, reported by /health and /ready
+readiness = Readiness(['bluetooth', 'telemetry'])
+
+# create bluetooth instance to use bluetoothctl features
+# the bluetoothctl session is started in the background by start_bluetooth(), so the server can accept clients right away
+bluetooth = Bluetooth(bluetoothctl_path=bluetoothctl_path, dbus_bus=player_dbus_bus, on_player_change=player_changed_event.set, connect=False, query_ttl=bluetooth_query_ttl, logger=logger)
 
 # Event to signal the dashboard update thread to stop
 stop_obd_connection_loop = Event()
 
+# Event to signal the telemetry thread to stop
+stop_telemetry_event = Event()
+
+# collects the obd values and sends them as one 'telemetry' frame every `dashboard_update_time` seconds
+telemetry = TelemetryAggregator(
+    emit=lambda frame: emit('telemetry', frame),
+    interval=dashboard_update_time,
+    logger=logger,
+)
+
+# keeps the last `telemetry_history_size` samples of every command for /telemetry/history
+telemetry_history = TelemetryHistory(capacity=telemetry_history_size)
+
+# writes every sample to disk, a new trip is started every time the car connects
+trip_recorder = TripRecorder(trip_directory, logger=logger) if trip_recording else None
+
 # Event to signal the player update thread to stop
 stop_player_updates_event = Event()
 
-def speed_update(speed):
+def publish_derived_sample(name: str, timestamp: float, value: float):
+    """
+    Callback of the derived metrics. Stores the value in the telemetry aggregator and the history.
+    It is not recorded, it can be computed again from the recorded samples.
+    """
 
-    data = str(speed.value.magnitude) if not speed.is_null() else '0'
+    telemetry.update(name, value)
+    telemetry_history.append(name, timestamp, value)
 
-    socketio.emit('speed', data)
+# computes acceleration, gear, trip distance, average speed and idle time from the samples, they are sent like other telemetry values
+derived_metrics = DerivedMetrics(load_derived_config(obd_config_path), publish_derived_sample, logger=logger) if derived_metrics_enabled else None
 
-def rpm_update(rpm):
+# smooths the values of the commands configured in the `smoothing` section of the obd config before they are sent, None if there is none
+smoother = load_smoothing_config(obd_config_path)
 
-    data = str(rpm.value.magnitude) if not rpm.is_null() else '0'
+def start_trip():
+    """
+    Is called every time the car connects. Starts a new recorded trip and resets the derived metrics of the trip.
+    """
+
+    if derived_metrics: derived_metrics.reset()
+    if smoother: smoother.reset()
+    if trip_recorder: trip_recorder.start_trip()
+
+def end_trip():
+    """
+    Is called every time the car disconnects. Ends the recorded trip and clears the telemetry values,
+    so clients (and the snapshot of clients connecting later) do not show the last values as if they were live.
+    """
+
+    telemetry.clear()
 
-    socketio.emit('rpm', data)
+    if trip_recorder: trip_recorder.end_trip()
 
-def init_obd():
+def publish_sample(name: str, timestamp: float, value: float):
     """
-    Initializes a new obd connection and sets up watchers to send data per websocket.    
+    Callback of the telemetry source. Stores the sample in the telemetry aggregator, the history and the trip recorder
+    and passes it on to the derived metrics.
+    Only the telemetry aggregator gets the smoothed value, the history, the recording and the derived metrics use the sample as it is.
     """
 
-    global obd_conn
+    samples_total.inc(name=name)
+
+    last_sample_time = last_sample_times.get(name)
+    last_sample_times[name] = timestamp
+
+    if last_sample_time is not None: sample_interval_seconds.observe(timestamp - last_sample_time, name=name)
+
+    smoothed = smoother.update(name, timestamp, value) if smoother else None
 
-    ports = obd.scan_serial()
+    if smoothed:
+        smoothed_value, velocity = smoothed
+        telemetry.update(name, smoothed_value, velocity=velocity, timestamp=timestamp)
+    else:
+        telemetry.update(name, value)
+
+    telemetry_history.append(name, timestamp, value)
+
+    if trip_recorder: trip_recorder.record(name, timestamp, value)
 
-    adapter_port = ''
+    if derived_metrics: derived_metrics.handle_sample(name, timestamp, value)
 
-    # my current adapter has 'serial' in the name so I use that to select it
-    for port in ports:
-        if obd_adapter_serial_name in port:
-            logger.info('An obd adapter was found: %s', port)
-            adapter_port = port
-    
-    if adapter_port == '':
-        logger.error('No obd adapter was found')
+def create_telemetry_source() -> TelemetrySource:
+    """
+    Creates the telemetry source selected by `TELEMETRY_SOURCE`: 'obd' (default), 'synthetic' or 'replay'.
+    With `OBD_PROCESS` the obd and synthetic sources run in a worker process.
+    """
 
-    logger.info('Trying to initialize connection: \'%s\'', adapter_port)
+    on_status = lambda message: emit('obd_status', { 'message': message })
+    on_ready = lambda message: readiness.set('telemetry', READY, message)
+
+    # effective queries per second of every obd command, they change with the adaptive polling
+    on_rates = lambda rates: emit('obd_rates', rates)
+
+    if obd_process and telemetry_source_name in ('obd', 'synthetic'):
+        worker_args = ['--source', telemetry_source_name, '--config', obd_config_path, '--serial-name', obd_adapter_serial_name, '--cache-path', obd_cache_path]
+
+        if telemetry_source_name == 'synthetic':
+            worker_args += ['--pid-count', os.environ.get('SYNTHETIC_PID_COUNT', '2'), '--sample-rate', os.environ.get('SYNTHETIC_SAMPLE_RATE', '10')]
+
+        return ObdWorkerSource(
+            publish_sample,
+            worker_args,
+            stall_timeout=float(os.environ.get('OBD_STALL_TIMEOUT', '10')),
+            on_connect=start_trip,
+            on_disconnect=end_trip,
+            on_rates=on_rates,
+            on_status=on_status,
+            on_ready=on_ready,
+            logger=logger,
+        )
+
+    if telemetry_source_name == 'synthetic':
+        return SyntheticSource(
+            publish_sample,
+            pid_count=int(os.environ.get('SYNTHETIC_PID_COUNT', '2')),
+            sample_rate=float(os.environ.get('SYNTHETIC_SAMPLE_RATE', '10')),
+            on_status=on_status,
+            on_ready=on_ready,
+            logger=logger,
+        )
+
+    if telemetry_source_name == 'replay':
+        replay_path = os.environ.get('REPLAY_PATH')
+
+        if not replay_path: raise MissingReplayPathException()
+
+        return ReplaySource(
+            publish_sample,
+            replay_path,
+            speed=float(os.environ.get('REPLAY_SPEED', '1')),
+            loop=os.environ.get('REPLAY_LOOP', 'false') == 'true',
+            on_status=on_status,
+            on_ready=on_ready,
+            logger=logger,
+        )
+
+    return ObdSource(
+        publish_sample,
+        # commands to watch, read from the obd config or RPM and SPEED on every poll if there is none
+        load_watched_commands(obd_config_path),
+        adapter_serial_name=obd_adapter_serial_name,
+        cache_path=obd_cache_path,
+        # a new trip is recorded every time the car connects
+        on_connect=start_trip,
+        on_disconnect=end_trip,
+        on_rates=on_rates,
+        on_status=on_status,
+        on_ready=on_ready,
+        logger=logger,
+    )
+
+# produces the samples that are sent to the dashboard
+telemetry_source = create_telemetry_source()
+
+def start_bluetooth():
+    """
+    Starts the bluetoothctl session and fills the device registry. Runs in the background while the server already accepts clients.
+    """
 
-    obd_conn = obd.Async(adapter_port if adapter_port else None)
+    try:
+        bluetooth.start()
+        readiness.set('bluetooth', READY)
 
-    # dont start watchers, when no connection to car was made
-    if obd_conn.status() != obd.OBDStatus.CAR_CONNECTED:
-        logger.warning('Car is not connected on new connection: \'%s\'', adapter_port)
-        return
+        logger.info('Bluetooth is ready.')
+    except Exception as error:
+        readiness.set('bluetooth', FAILED, str(error))
 
-    obd_conn.watch(obd.commands.RPM, callback=rpm_update)
-    obd_conn.watch(obd.commands.SPEED, callback=speed_update)
+        logger.error('Bluetooth could not be started.', exc_info=1)
 
-    obd_conn.start()
+def run_telemetry_source():
+    """
+    Runs the telemetry source until the server stops. Marks the telemetry subsystem as failed if it crashes.
+    """
+
+    try:
+        telemetry_source.run(stop_obd_connection_loop)
+    except Exception as error:
+        readiness.set('telemetry', FAILED, str(error))
+
+        logger.error('The telemetry source stopped with an error.', exc_info=1)
+
+def start_bluetooth_and_player_updates():
+    """
+    Starts bluetooth and after that the loop sending player updates, which needs bluetooth.
+    """
+
+    start_bluetooth()
+    update_and_send_player_data()
+
+def log_metrics():
+    """
+    Logs a summary of the metrics every `metrics_log_interval` seconds.
+    """
+
+    while not stop_player_updates_event.wait(metrics_log_interval):
+        logger.info('Metrics:\n%s', registry.summary())
 
 def shutdown_server():
     """
@@ -104,15 +377,17 @@ def shutdown_server():
     logger.info('Sending stop signal to threads.')
     stop_obd_connection_loop.set()
     stop_player_updates_event.set()
+    stop_telemetry_event.set()
 
     # stop obd update loop
-    obd_conn.stop()
-    obd_conn.unwatch_all()
+    telemetry_source.close()
 
     # tell player to clean up
     logger.info('Cleaning up instances.')
     bluetooth.clean_up()
 
+    if player.volume_controller: player.volume_controller.close()
+
     # schedule shutdown on machine
     logger.info('Scheduling a shutdown.')
     subprocess.run(['shutdown', '-h', 'now'])
@@ -125,122 +400,235 @@ def shutdown_server():
     logger.info('Exiting program.')
     sys.exit()
 
+def player_data(devices: list = None) -> dict:
+    """
+    The 'player_update' data of the current player. Uses the state the player already has, nothing is sent to `bluetoothctl`.
+
+    :param devices: Devices to include, the 'devices' key is left out if None.
+    """
+
+    # the player could be unset by another thread in the meantime
+    current_player = bluetooth.player
+
+    data = {
+        'title': '',
+        'interpret': '',
+        'length': 0,
+        'isPlaying': False,
+        'volume': 0,
+        'error': 'A bluetooth connected device with music playing is required to use player actions.',
+    }
+
+    if current_player:
+        data.update({
+            'title': current_player.song['title'],
+            'interpret': current_player.song['interpret'],
+            'length': current_player.song['length'],
+            'isPlaying': current_player.isPlaying,
+            'volume': current_player.volume,
+            'error': None,
+        })
+
+    if devices is not None: data['devices'] = [dict(device.__dict__) for device in devices]
+
+    return data
+
 def update_and_send_player_data():
     """
     Creates an endless loop that sends updates to the dashboard per websocket.
     The data sent, involves player specific data like the song currently playing.
+
+    If the player can be watched over D-Bus, an update is only sent when the player reports a change.
+    Otherwise the player is polled every `sleep_time` seconds.
     """
 
     sleep_time = 5
 
+    # set while bluetoothctl fails, /ready reports bluetooth as failed until it answers again
+    bluetooth_failed = False
+
     logger.info('Starting to send player updates.')
 
     while not stop_player_updates_event.is_set():
 
-        logger.info('Trying to send player update')
-
-        if not bluetooth.player:
-            
-            try:
-                player_names = bluetooth.list_players()
+        # the player is not queried, if no client shows it
+        if not subscriptions.wait_for_subscribers('player_update', sleep_time): continue
 
-                # use the first player found
-                bluetooth.set_player(player_names[0])
+        try:
+            logger.debug('Trying to send player update')
 
-                logger.info('A new player \'%s\' was found and set', bluetooth.player.bluez_player_path)
+            # a request can set or unset the player at any time, this iteration sticks to the one it got
+            had_player = bluetooth.player is not None
+            current_player = bluetooth.ensure_player()
 
-            except IndexError:
+            if not current_player:
 
-                logger.info('No player was found, sending player update with no data except for devices')
+                logger.debug('No player was found, sending player update with no data except for devices')
 
                 devices = bluetooth.list_devices()
 
-                socketio.emit('player_update', json.dumps({
-                'title': '',
-                'interpret': '',
-                'length': 0,
-                'isPlaying': False,
-                'volume': 0,
-                'devices': [device.__dict__ for device in devices],
-                'error': 'A bluetooth connected device with music playing is required to use player actions.',
-            }))
-
-                time.sleep(sleep_time)
+                emit_delta('player_update', player_data(devices))
+
+                if bluetooth_failed:
+                    bluetooth_failed = False
+                    readiness.set('bluetooth', READY)
+
+                stop_player_updates_event.wait(sleep_time)
                 continue
-        
-        try:
 
-            bluetooth.player.update()
-            devices = bluetooth.list_devices()
+            if not had_player:
+                logger.info('A new player \'%s\' was found and set', current_player.bluez_player_path)
 
-            data_string = json.dumps({
-                'title': bluetooth.player.song['title'],
-                'interpret': bluetooth.player.song['interpret'],
-                'length': bluetooth.player.song['length'],
-                'isPlaying': bluetooth.player.isPlaying,
-                'volume': bluetooth.player.volume,
-                'devices': [device.__dict__ for device in devices],
-                'error': None,
-            })
+            try:
+
+                if current_player.monitor:
+                    # wait for the player to report a change, but check regularly that it still exists
+                    # the devices are not watched over D-Bus, so they are sent on every check as well (only if they changed)
+                    if not player_changed_event.wait(sleep_time):
+                        if not bluetooth.player_exists(current_player.bluez_player_path):
+                            raise PlayerNotFoundException(current_player.bluez_player_path)
+
+                    player_changed_event.clear()
+                elif player_changed_event.is_set():
+                    # the player was updated already, after an action was confirmed
+                    player_changed_event.clear()
+                elif had_player:
+                    # the state and the check that the player still exists in one round trip
+                    bluetooth.update_player(current_player)
+                # else: set_player got the state of the new player already
+
+                devices = bluetooth.list_devices()
+
+                # nothing is sent if nothing changed since the last update
+                delta = emit_delta('player_update', player_data(devices))
 
-            logger.info('Sending player update:\n%s', data_string)
+                if delta: logger.debug('Sent player update: %s', delta)
+            except PlayerNotFoundException:
+                logger.warning('The player \'%s\' does not exist anymore.', current_player.bluez_player_path)
+                logger.info('Setting player on bluetooth instance to None')
+                bluetooth.unset_player(current_player)
 
-            socketio.emit('player_update', data_string)
-        except PlayerNotFoundException:
-            logger.warning('The player \'%s\' does not exist anymore.', bluetooth.player.bluez_player_path)
-            logger.info('Setting player on bluetooth instance to None')
-            bluetooth.unset_player()
+                logger.info('Sending empty player update')
 
-            logger.info('Sending empty player update')
+                emit_delta('player_update', player_data())
 
-            socketio.emit('player_update', json.dumps({
-            'title': '',
-            'interpret': '',
-            'length': 0,
-            'isPlaying': False,
-            'volume': 0,
-            'error': 'A bluetooth connected device with music playing is required to use player actions.',
-        }))
+            # bluetoothctl answered again
+            if bluetooth_failed:
+                bluetooth_failed = False
+                readiness.set('bluetooth', READY)
 
-        time.sleep(sleep_time)
+            if not current_player.monitor or not bluetooth.player:
+                # an action confirmed by the player ends the wait early
+                player_changed_event.wait(sleep_time)
 
-def obd_connection_loop():
+        except bluetoothctl_errors as error:
+            # the session is respawned by the next command, until then the player loop keeps trying
+            logger.error('bluetoothctl failed while updating the player, trying again in %s seconds.', sleep_time, exc_info=1)
+
+            bluetooth_failed = True
+            readiness.set('bluetooth', FAILED, str(error))
+
+            stop_player_updates_event.wait(sleep_time)
+
+def parse_channels(data) -> list:
     """
-    First it calls init_obd(). After that it creates an endless loop that tries to initiate a connection over obd to the car.
-    This also sends the current obd status as websocket update.
+    Channels can be requested as list (['telemetry', 'obd_status']), comma separated string ('telemetry,obd_status') or dictionary ({ 'channels': ... }).
     """
 
-    init_obd()
+    if isinstance(data, dict): data = data.get('channels')
+
+    if isinstance(data, str): data = [channel.strip() for channel in data.split(',') if channel.strip()]
+
+    return data if isinstance(data, list) else None
+
+def send_snapshot(sid: str, channels: list):
+    """
+    Sends the current state of `channels` to the client `sid` as one 'snapshot' message: { <channel>: <data> }.
+    Channels without any state yet are left out. 'player_update' is sent as full state with its version.
+    """
+
+    # the player loop does not run while nobody is subscribed, so the stored player state could be old
+    # the player and the registry have the current state in memory, only the devices are left out until the registry is synced
+    if 'player_update' in channels and (bluetooth.registry.synced or state_store.version('player_update') == 0):
+        # the other clients get the changes as delta, this one gets them in the snapshot
+        emit_delta('player_update', player_data(bluetooth.registry.list_devices() if bluetooth.registry.synced else None), skip=sid)
+
+    snapshot = state_store.snapshot(channels)
+
+    outbound.send_to([sid], 'snapshot', json.dumps(snapshot))
+
+@socketio.on('connect')
+def handle_connect(auth=None):
+    """
+    Subscribes the client to the channels from `auth` or the query parameter `channels` and sends it the current state of them.
+    Clients that do not ask for specific channels are subscribed to all of them.
+    """
+
+    channels = parse_channels(auth) or parse_channels(request.args.get('channels')) or subscriptions.channels
+
+    outbound.add(request.sid)
+    subscriptions.subscribe(request.sid, channels)
+
+    logger.info('Client \'%s\' connected, subscribed to: %s', request.sid, subscriptions.channels_of(request.sid))
+
+    send_snapshot(request.sid, subscriptions.channels_of(request.sid))
+
+@socketio.on('disconnect')
+def handle_disconnect(reason=None):
+    subscriptions.remove(request.sid)
+    outbound.remove(request.sid)
+
+@socketio.on('subscribe')
+def handle_subscribe(data):
+    """
+    Adds channels to the subscriptions of the client and sends it the current state of the new ones.
+    Returns all channels the client is subscribed to.
+    """
+
+    added = subscriptions.subscribe(request.sid, parse_channels(data) or [])
+
+    if added: send_snapshot(request.sid, added)
 
-    while not stop_obd_connection_loop.is_set():
-        time.sleep(5)
+    return subscriptions.channels_of(request.sid)
 
-        if obd_conn.status() == obd.OBDStatus.CAR_CONNECTED:
-            socketio.emit('obd_status', json.dumps({ 'message': 'Car connected' }))
+@socketio.on('resync')
+def handle_resync(data=None):
+    """
+    Sends the current state of the channels again, e.g. because the client got a delta whose `base` is not the version it has.
+    All channels of the client are sent if no channels are given.
+    """
 
-            logger.info('Connected to car')
-            continue
+    channels = [channel for channel in (parse_channels(data) or subscriptions.channels_of(request.sid)) if channel in subscriptions.channels_of(request.sid)]
 
-        # close connection, because a new one will be established
-        obd_conn.close()
-        init_obd()
+    if channels: send_snapshot(request.sid, channels)
 
-        if obd_conn.status() == obd.OBDStatus.NOT_CONNECTED:
+@socketio.on('unsubscribe')
+def handle_unsubscribe(data):
+    """
+    Removes channels from the subscriptions of the client. Returns all channels the client is still subscribed to.
+    """
 
-            socketio.emit('obd_status', json.dumps({ 'message': 'Not connected to the obd adapter' }))
+    subscriptions.unsubscribe(request.sid, parse_channels(data) or [])
 
-            logger.error('No connection to obd adapter')
+    return subscriptions.channels_of(request.sid)
 
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
 
-        elif obd_conn.status() == obd.OBDStatus.ELM_CONNECTED:
-            socketio.emit('obd_status', json.dumps({ 'message': 'Connected to adapter, but no car was detected' }))
+@app.after_request
+def observe_request(response):
+    """
+    Measures every http request. The endpoint (e.g. 'player_endpoint') is used as label instead of the path, to keep the number of labels small.
+    """
 
-            logger.error('Connected to adapter \'%s\', but no car was detected', obd_conn.port_name())
+    if 'request_start' in g:
+        endpoint = request.endpoint or 'unknown'
 
-        elif obd_conn.status() == obd.OBDStatus.OBD_CONNECTED:
-            socketio.emit('obd_status', json.dumps({ 'message': 'Connected to car, ignition off' }))
+        http_request_seconds.observe(time.perf_counter() - g.request_start, endpoint=endpoint)
+        http_requests_total.inc(endpoint=endpoint, status=str(response.status_code))
 
-            logger.info('Connected to car (through \'%s\'), ignition off', obd_conn.port_name())
+    return response
 
 @app.route('/bluetooth/<string:action>', methods=['POST'])
 def bluetooth_endpoint(action):
@@ -280,24 +668,23 @@ def bluetooth_endpoint(action):
 def player_endpoint(action):
     """
     :param action: 'play_pause' | 'forward' | 'back'
-    :return: dictionary { 'title': str, 'interpret': str, 'length': int, 'isPlaying': bool }
+    :return: dictionary { 'title': str, 'interpret': str, 'length': int, 'isPlaying': bool, 'version': int }
+
+    `version` is the version of the last 'player_update' state, the response is that state with the action applied.
+    The confirmed state comes as 'player_update' delta with a higher version, so clients know which of the two is newer.
     """
 
-    if not bluetooth.player:
-        
-        try:
-            player_names = bluetooth.list_players()
+    # the player loop can replace the player at any time, the request sticks to the one it got
+    current_player = bluetooth.ensure_player()
 
-            # use the first player found
-            bluetooth.set_player(player_names[0])
-        except IndexError:
-            return { 'error': 'A bluetooth connected device with music playing is required to use player actions.' }, 400
+    if not current_player:
+        return { 'error': 'A bluetooth connected device with music playing is required to use player actions.', 'version': state_store.version('player_update') }, 400
 
     # call player method corresponding to action
 
     try:
         if action == 'play_pause':
-            bluetooth.player.toggle_play()
+            current_player.toggle_play()
 
         # elif action == 'skip_to':
         #     percentage = request.form.get('percentage')
@@ -305,35 +692,90 @@ def player_endpoint(action):
 
         elif action == 'volume_to':
             percentage = request.form.get('percentage')
-            bluetooth.player.set_volume(float(percentage))
+            current_player.set_volume(float(percentage))
 
         elif action == 'forward':
-            bluetooth.player.next()
+            current_player.next()
 
         elif action == 'back':
-            bluetooth.player.previous()
+            current_player.previous()
 
         else: return '', 404
  
-        # every player method should update the player instance by itsself
-        # -> get the data from player instance and respond with it
+        # player methods update the player instance optimistically and return right away
+        # -> respond with that data, the confirmed state is sent as 'player_update' when the player reports it
         response = {
-            'title': bluetooth.player.song['title'],
-            'interpret': bluetooth.player.song['interpret'],
-            'length': bluetooth.player.song['length'],
-            'isPlaying': bluetooth.player.isPlaying,
-            'volume': bluetooth.player.volume,
+            'title': current_player.song['title'],
+            'interpret': current_player.song['interpret'],
+            'length': current_player.song['length'],
+            'isPlaying': current_player.isPlaying,
+            'volume': current_player.volume,
             'error': None,
+            'version': state_store.version('player_update'),
         }
 
         return response, 200
 
     except PlayerNotFoundException:
-        logger.warning('The player \'%s\' does not exist anymore.', bluetooth.player.bluez_player_path)
+        logger.warning('The player \'%s\' does not exist anymore.', current_player.bluez_player_path)
         logger.info('Setting player on bluetooth instance to None')
-        bluetooth.unset_player()
+        bluetooth.unset_player(current_player)
+
+        return { 'error': 'A bluetooth connected device with music playing is required to use player actions.', 'version': state_store.version('player_update') }, 400
 
-        return { 'error': 'A bluetooth connected device with music playing is required to use player actions.' }, 400
+
+@app.route('/telemetry/history', methods=['GET'])
+def telemetry_history_endpoint():
+    """
+    :query commands: comma separated command names (e.g. 'rpm,speed'), all commands if not set
+    :query seconds: length of the time window ending now, defaults to 300
+    :query points: maximum number of points per command, defaults to 100
+    :return: dictionary { <command>: { 'timestamp': [float], 'min': [float], 'max': [float], 'mean': [float] } }
+    """
+
+    try:
+        seconds = float(request.args.get('seconds', '300'))
+        points = int(request.args.get('points', '100'))
+    except ValueError:
+        return { 'error': '`seconds` and `points` have to be numbers.' }, 400
+
+    if points < 1:
+        return { 'error': '`points` has to be at least 1.' }, 400
+
+    commands = request.args.get('commands')
+    names = commands.split(',') if commands else telemetry_history.names()
+
+    end = time.time()
+
+    return telemetry_history.query(names, end - seconds, end, points), 200
+
+
+@app.route('/health', methods=['GET'])
+def health_endpoint():
+    """
+    Answers as soon as the server accepts requests, with the state of every subsystem.
+    :return: dictionary { 'ready': bool, 'uptime': float, 'subsystems': { <name>: { 'state': 'starting' | 'ready' | 'failed', 'message': str } }, 'subscribers': { <channel>: int } }
+    """
+
+    return { 'ready': readiness.is_ready(), **readiness.to_dict(), 'subscribers': subscriptions.to_dict() }, 200
+
+
+@app.route('/ready', methods=['GET'])
+def ready_endpoint():
+    """
+    Like /health, but responds with 503 until every subsystem is ready.
+    """
+
+    return { 'ready': readiness.is_ready(), **readiness.to_dict() }, 200 if readiness.is_ready() else 503
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """
+    :return: all metrics in the Prometheus text format
+    """
+
+    return registry.render(), 200, { 'Content-Type': 'text/plain; version=0.0.4' }
 
 
 @app.route('/shutdown', methods=['POST'])
@@ -349,14 +791,23 @@ def shutdown():
 
 
 if __name__ == '__main__':
-    # start thread to create obd connection
-    update_dashboard_thread = Thread(target=obd_connection_loop)
-    update_dashboard_thread.daemon = True
-    update_dashboard_thread.start()
+    # background tasks are daemon threads in debug mode and greenlets in production mode
+
+    # bluetooth and obd are initialized concurrently, while the server is already accepting clients
+
+    # start task to create obd connection (or to generate/replay samples)
+    socketio.start_background_task(run_telemetry_source)
+
+    # start task to send the collected obd values as telemetry frames
+    socketio.start_background_task(telemetry.run, stop_telemetry_event)
+
+    # start task to start bluetooth and then send updated data for player
+    socketio.start_background_task(start_bluetooth_and_player_updates)
+
+    # start task to log a summary of the metrics regularly
+    if metrics_log_interval > 0:
+        socketio.start_background_task(log_metrics)
 
-    # start thread to send updated data for player
-    update_player_thread = Thread(target=update_and_send_player_data)
-    update_player_thread.daemon = True
-    update_player_thread.start()
+    logger.info('Starting server in %s mode on port %d.', server_mode, server_port)
 
-    socketio.run(app, '0.0.0.0', port=3333, debug=True, allow_unsafe_werkzeug=True)
+    socketio.run(app, '0.0.0.0', port=server_port, debug=server_debug, allow_unsafe_werkzeug=True)
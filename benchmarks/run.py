@@ -0,0 +1,242 @@
+"""
+End-to-end benchmark of the server.
+
+Starts app.py with the synthetic telemetry source and the stub `bluetoothctl`/`amixer` programs in benchmarks/stubs,
+connects `--clients` socket.io clients and measures:
+
+- the latency from creating a telemetry frame on the server to receiving it on a client (p50/p99/max)
+- the telemetry messages per second over all clients
+- the latency of the /player/* and /bluetooth/* endpoints
+
+The results are written as json to `--output`, so runs can be compared.
+
+usage: python benchmarks/run.py --clients 10 --duration 30
+"""
+
+import os
+import sys
+import json
+import time
+import signal
+import socket
+import argparse
+import subprocess
+import urllib.error
+import urllib.parse
+import urllib.request
+from threading import Thread, Lock
+from typing import Dict, List
+
+import socketio
+
+
+benchmark_directory = os.path.dirname(os.path.abspath(__file__))
+repository_directory = os.path.dirname(benchmark_directory)
+stub_directory = os.path.join(benchmark_directory, 'stubs')
+
+http_endpoints = [
+    ('/bluetooth/devices', {}),
+    ('/bluetooth/discoverable', { 'status': 'true' }),
+    ('/bluetooth/pairable', { 'status': 'true' }),
+    ('/player/play_pause', {}),
+    ('/player/forward', {}),
+    ('/player/back', {}),
+    ('/player/volume_to', { 'percentage': '0.5' }),
+]
+
+
+def percentile(sorted_values: List[float], percent: float) -> float:
+
+    if not sorted_values: return None
+
+    index = min(int(len(sorted_values) * percent / 100), len(sorted_values) - 1)
+
+    return sorted_values[index]
+
+
+def summarize(values: List[float]) -> Dict[str, float]:
+    """
+    Returns count, p50, p99 and max of `values` (in milliseconds).
+    """
+
+    values = sorted(values)
+
+    return {
+        'count': len(values),
+        'p50': percentile(values, 50),
+        'p99': percentile(values, 99),
+        'max': values[-1] if values else None,
+    }
+
+
+def free_port() -> int:
+
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(port: int, server_mode: str, pid_count: int, sample_rate: float, update_time: float, obd_process: bool) -> subprocess.Popen:
+
+    env = dict(os.environ)
+    env.update({
+        'SERVER_PORT': str(port),
+        'SERVER_DEBUG': 'false',
+        'SERVER_MODE': server_mode,
+        'TELEMETRY_SOURCE': 'synthetic',
+        'SYNTHETIC_PID_COUNT': str(pid_count),
+        'SYNTHETIC_SAMPLE_RATE': str(sample_rate),
+        'DASHBOARD_UPDATE_TIME': str(update_time),
+        'TRIP_RECORDING': 'false',
+        'OBD_PROCESS': 'true' if obd_process else 'false',
+        'BLUETOOTHCTL_PATH': os.path.join(stub_directory, 'bluetoothctl'),
+        'AMIXER_PATH': os.path.join(stub_directory, 'amixer'),
+        # the stub bluetoothctl has no D-Bus player, so the player is polled
+        'PLAYER_DBUS_BUS': 'unix:path=/nonexistent',
+    })
+
+    # own session, so the server and everything it spawned can be stopped together
+    return subprocess.Popen(
+        [sys.executable, os.path.join(repository_directory, 'app.py')],
+        cwd=repository_directory,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True,
+    )
+
+
+def wait_for_server(url: str, timeout: float) -> None:
+
+    deadline = time.monotonic() + timeout
+
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(url + '/bluetooth/devices', data=b'', timeout=1)
+            return
+        except (urllib.error.URLError, ConnectionError):
+            time.sleep(0.2)
+
+    raise TimeoutError(f'The server at {url} did not start within {timeout} seconds.')
+
+
+class TelemetryClient():
+    """
+    A socket.io client that records the latency of every telemetry frame it receives.
+    """
+
+    def __init__(self, url: str) -> None:
+
+        self.latencies: List[float] = list()
+        self.lock = Lock()
+
+        self.client = socketio.Client()
+        self.client.on('telemetry', self.handle_telemetry)
+        self.client.connect(url, transports=['websocket'])
+
+    def handle_telemetry(self, data: str) -> None:
+
+        received = time.time()
+        frame = json.loads(data)
+
+        with self.lock:
+            self.latencies.append((received - frame['timestamp']) * 1000)
+
+    def reset(self) -> None:
+
+        with self.lock:
+            self.latencies = list()
+
+    def disconnect(self) -> None:
+        self.client.disconnect()
+
+
+def measure_http(url: str, requests_per_endpoint: int) -> Dict[str, Dict[str, float]]:
+
+    results = dict()
+
+    for path, form in http_endpoints:
+        latencies = list()
+        errors = 0
+
+        for _ in range(requests_per_endpoint):
+            start = time.perf_counter()
+
+            try:
+                urllib.request.urlopen(url + path, data=urllib.parse.urlencode(form).encode(), timeout=10).read()
+            except (urllib.error.URLError, ConnectionError):
+                errors += 1
+                continue
+
+            latencies.append((time.perf_counter() - start) * 1000)
+
+        results[path] = summarize(latencies)
+        results[path]['errors'] = errors
+
+    return results
+
+
+def main() -> None:
+
+    parser = argparse.ArgumentParser(description='End-to-end latency and throughput benchmark of the dashboard server.')
+    parser.add_argument('--server-mode', choices=['debug', 'production'], default='production', help='SERVER_MODE of the server')
+    parser.add_argument('--clients', type=int, default=5, help='number of socket.io clients')
+    parser.add_argument('--duration', type=float, default=20, help='seconds telemetry is measured')
+    parser.add_argument('--pid-count', type=int, default=2, help='commands generated by the synthetic source')
+    parser.add_argument('--sample-rate', type=float, default=10, help='samples per second and command')
+    parser.add_argument('--update-time', type=float, default=0.2, help='DASHBOARD_UPDATE_TIME of the server')
+    parser.add_argument('--obd-process', action='store_true', help='generate the samples in the obd worker process')
+    parser.add_argument('--http-requests', type=int, default=20, help='requests per http endpoint')
+    parser.add_argument('--output', default=os.path.join(benchmark_directory, 'results', time.strftime('%Y%m%d-%H%M%S') + '.json'))
+    args = parser.parse_args()
+
+    port = free_port()
+    url = f'http://127.0.0.1:{port}'
+
+    server = start_server(port, args.server_mode, args.pid_count, args.sample_rate, args.update_time, args.obd_process)
+
+    try:
+        wait_for_server(url, timeout=30)
+
+        clients = [TelemetryClient(url) for _ in range(args.clients)]
+
+        # let the connections settle before measuring
+        time.sleep(1)
+        for client in clients: client.reset()
+
+        # requests run while telemetry is measured, so their effect on the latency is part of the result
+        http_results = dict()
+        http_thread = Thread(target=lambda: http_results.update(measure_http(url, args.http_requests)))
+        http_thread.start()
+
+        time.sleep(args.duration)
+
+        latencies = [latency for client in clients for latency in client.latencies]
+
+        http_thread.join()
+
+        for client in clients: client.disconnect()
+
+    finally:
+        os.killpg(server.pid, signal.SIGTERM)
+        server.wait()
+
+    results = {
+        'config': vars(args),
+        'telemetry': {
+            'latency_ms': summarize(latencies),
+            'messages_per_second': len(latencies) / args.duration,
+        },
+        'http_latency_ms': http_results,
+    }
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+
+    with open(args.output, 'w') as output_file:
+        json.dump(results, output_file, indent=2)
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,20 +1,34 @@
 import logging
-import subprocess
-from typing import List
+from threading import RLock
+from typing import Any, Callable, Dict, List
 
-from player import Player
+from player import Player, PlayerNotFoundException, parse_show
+from metrics import registry
 from device import Device
+from registry import BluetoothRegistry
+from single_flight import SingleFlight
+from bluetoothctl_session import BluetoothctlSession
+
+
+parse_seconds = registry.histogram('bluetooth_parse_seconds', 'Time spent parsing the output of `bluetoothctl`, labeled by the query.')
 
     
 class Bluetooth():
     """
     A python wrapper for the `bluetoothctl` utility.
     It needs the `bluetoothctl` utility installed on the system, without it, it will not work at all.
+
+    It is shared by the player loop and the request threads:
+    the player is set and unset under a lock and identical queries that run at the same time are only sent once.
     """
 
     player: Player = None
 
-    def __init__(self, bluetoothctl_path: str = 'bluetoothctl', logger: logging.Logger = None) -> None:
+    def __init__(self, bluetoothctl_path: str = 'bluetoothctl', dbus_bus: str = 'SYSTEM', on_player_change: Callable[[], None] = None, connect: bool = True, query_ttl: float = 0.5, logger: logging.Logger = None) -> None:
+        """
+        :param connect: Start the `bluetoothctl` session right away. If False, start() has to be called (e.g. in the background) or the session is started by the first command.
+        :param query_ttl: Seconds the result of a query (`devices`, `list`, `show`) is reused by other callers.
+        """
 
         # if logger is set, use it
         # if logger is not set a null_logger is created that wont log anything
@@ -34,39 +48,103 @@ class Bluetooth():
         self.bluetoothctl_path = bluetoothctl_path
         """Defines the path/name of the `bluetoothctl` program. You should change that to match the name/path of the tool on your system."""
 
+        self.dbus_bus = dbus_bus
+        """The bus players are watched on for changes ('SYSTEM', 'SESSION' or the address of a bus)."""
+
+        self.on_player_change = on_player_change
+        """Is called every time the player reports a change over D-Bus. If it is not set, players are not watched."""
+
+        self.registry = BluetoothRegistry()
+        """Known devices and players, kept up to date by the events of the session."""
+
+        self.query_ttl = query_ttl
+
+        self.queries = SingleFlight(query_ttl)
+        """Shares the results of queries between callers asking at the same time."""
+
+        # a sync is never reused, after a restart of the session the registry has to be synced again
+        self.syncs = SingleFlight()
+
+        # held while the player is set or unset
+        self.player_lock = RLock()
+
+        self.session = BluetoothctlSession(
+            bluetoothctl_path,
+            on_event=self.registry.handle_event,
+            # events could have been missed while there was no session
+            on_start=self.registry.reset,
+            logger=self.logger,
+        )
+        """The `bluetoothctl` process all commands are sent to."""
+
+        if connect: self.start()
+
+    def start(self) -> None:
+        """
+        Starts the `bluetoothctl` session and fills the registry.
+        """
+
         # check defined bluetoothctl path by trying to open a process
         # this will raise BluetoothctlNotFoundException if path is wrong
         self.commands([])
 
+        self.ensure_registry()
+
     def commands(self, commands: List[str], exit_after_commands = True) -> str:
         """
         Executes the list of commands against the `bluetootctl` program. Returns the all the output as string.
 
-        Also sends 'exit' command after sending `commands[]`, if not specified otherwhise with `exit_after_commands`
+        The commands are sent to a long-lived `bluetoothctl` session, which is started on the first call.
+        `exit_after_commands` is kept for compatibility, the session is only ended by clean_up().
+        """
+
+        return self.batch([commands])[0]
+
+    def batch(self, queries: List[List[str]]) -> List[str]:
+        """
+        Executes several lists of commands in one round trip. Returns the output of every list, in the same order.
         """
 
         try:
             # this could raise an exception if bluetoothctl is not preset on system
-            process = subprocess.Popen([self.bluetoothctl_path], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+            return self.session.batch(queries)
 
-        # file not found error is raised by Popen, when there is no program at `BLUETOOTHCTL_MODULE_NAME`
+        # file not found error is raised by Popen, when there is no program at `bluetoothctl_path`
         # raise more specific error: BluetoothctlNotFound with the filename (name of program)
         except FileNotFoundError as error:
             raise BluetoothctlNotFoundException(error.filename)
+    
+    def batch_query(self, queries: List[str], player_name: str = None) -> Dict[str, Any]:
+        """
+        Runs several queries in one round trip and returns their parsed results by query name:
 
-        for command in commands:
-            self.logger.info('Sending command to bluetoothctl: \'%s\'', command)
-            process.stdin.write(command + '\n')
+        - 'devices': List[Device], like query_devices()
+        - 'players': List[str], like query_players()
+        - 'show': Dict[str, str], the properties of the player `player_name` (see player.parse_show())
 
-        if exit_after_commands: process.stdin.write('exit\n')
-        
-        out, err = process.communicate()
+        Raises UnknownQueryException if a query does not exist.
+        """
 
-        if err:
-            raise err
+        query_commands = {
+            'devices': ['devices'],
+            'players': ['menu player', 'list'],
+            'show': ['menu player', f'select {player_name}', 'show'],
+        }
+
+        parsers = {
+            'devices': self.parse_devices,
+            'players': self.parse_players,
+            'show': parse_show,
+        }
+
+        for query in queries:
+            if query not in query_commands:
+                raise UnknownQueryException(query)
+
+        outputs = self.batch([query_commands[query] for query in queries])
+
+        return { query: parsers[query](out) for query, out in zip(queries, outputs) }
 
-        return out
-    
     def command(self, command: str) -> str:
         """
         Executes a command against the `bluetootctl` program. Returns the all the output as string.
@@ -75,12 +153,78 @@ class Bluetooth():
         """
         return self.commands([command])
 
+    def sync_registry(self) -> None:
+        """
+        Fills the registry with the devices (including their paired/connected state) and players `bluetoothctl` knows.
+        Is called on the first lookup after a session was started, after that the registry is kept up to date by events.
+        """
+
+        self.logger.info('Syncing bluetooth registry.')
+
+        devices = self.query_devices()
+
+        if devices:
+            out = self.commands(['info ' + device.mac_address for device in devices])
+
+            devices_by_mac_address = { device.mac_address: device for device in devices }
+            device = None
+
+            # output of info starts with 'Device <mac address> (public)' followed by indented properties
+            for line in out.split('\n'):
+                if line.startswith('Device'):
+                    device = devices_by_mac_address.get(line.split(' ')[1])
+                    continue
+
+                line = line.strip()
+
+                if not device: continue
+
+                if line.startswith('Paired:'):
+                    device.paired = line.endswith('yes')
+                elif line.startswith('Connected:'):
+                    device.connected = line.endswith('yes')
+
+        self.registry.replace(devices, self.query_players())
+
+    def ensure_registry(self) -> None:
+        """
+        Syncs the registry if it was not synced since the session was started.
+        """
+
+        # starts the session if it is not running, which resets the registry
+        if not self.session.is_alive():
+            self.commands([])
+
+        if not self.registry.synced:
+            # callers that come in while the registry is synced wait for that sync
+            self.syncs.do('registry', self.sync_registry)
+
     def list_players(self) -> List[str]:
         """
         Returns a list of all the specific bluez player names.
+
+        Is answered by the registry, no command is sent to `bluetoothctl` once it was synced.
+        """
+
+        self.ensure_registry()
+
+        return self.registry.list_players()
+
+    def query_players(self) -> List[str]:
+        """
+        Asks `bluetoothctl` for all the specific bluez player names. Concurrent calls share one query.
         """
 
-        out = self.commands(['menu player', 'list'])
+        return self.queries.do('players', self._query_players)
+
+    def _query_players(self) -> List[str]:
+
+        return self.parse_players(self.commands(['menu player', 'list']))
+
+    def parse_players(self, out: str) -> List[str]:
+        """
+        Returns the player names of the output of `list` in the player menu.
+        """
 
         player_names = list()
 
@@ -92,23 +236,92 @@ class Bluetooth():
 
     def player_exists(self, player_name: str) -> bool:
 
-        player_names = self.list_players()
+        self.ensure_registry()
 
-        return player_name in player_names
+        return self.registry.has_player(player_name)
     
     def set_player(self, player_name: str) -> None:
         """
         Creates an instance of player which uses `player_name` and sets it to self.player.
+        If `on_player_change` is set, the player is watched over D-Bus.
         """
-        self.player = Player(
-            # player class uses the commands function of this class to execute bluetoothctl commands
-            self.commands,
-            player_name,
-            logger=self.logger,
-        )
-    
-    def unset_player(self) -> None:
-        self.player = None
+
+        with self.player_lock:
+            self.unset_player()
+
+            # checks that the player exists and gets its state in one round trip
+            results = self.batch_query(['players', 'show'], player_name)
+
+            if player_name not in results['players']:
+                raise PlayerNotFoundException(player_name)
+
+            new_player = Player(
+                # player class uses the commands function of this class to execute bluetoothctl commands
+                self.commands,
+                player_name,
+                dbus_bus=self.dbus_bus,
+                query_ttl=self.query_ttl,
+                properties=results['show'],
+                logger=self.logger,
+            )
+
+            if self.on_player_change:
+                new_player.watch(self.on_player_change)
+
+            # only set when it is ready, other threads never see a half initialized player
+            self.player = new_player
+
+    def update_player(self, player: Player) -> None:
+        """
+        Updates `player` and checks that it still exists, in one round trip.
+        Concurrent calls for the same player share the round trip.
+
+        Raises PlayerNotFoundException if the player does not exist anymore.
+        """
+
+        results = self.queries.do('player ' + player.bluez_player_path, lambda: self.batch_query(['players', 'show'], player.bluez_player_path))
+
+        if player.bluez_player_path not in results['players']:
+            raise PlayerNotFoundException(player.bluez_player_path)
+
+        player.apply_show(results['show'])
+
+    def ensure_player(self) -> Player:
+        """
+        Returns the current player. If there is none, the first player found is set.
+        Returns None if there is no player.
+
+        Callers should keep the returned player in a local variable, self.player can be replaced by another thread at any time.
+        """
+
+        with self.player_lock:
+            if not self.player:
+                player_names = self.list_players()
+
+                if player_names:
+                    try:
+                        # use the first player found
+                        self.set_player(player_names[0])
+                    except PlayerNotFoundException:
+                        # it was removed since the registry saw it
+                        self.logger.info('The player \'%s\' does not exist anymore.', player_names[0])
+
+            return self.player
+
+    def unset_player(self, player: Player = None) -> None:
+        """
+        Stops watching the current player and sets self.player to None.
+
+        :param player: Only unset the player if it is still this one, a player another thread set in the meantime is kept.
+        """
+
+        with self.player_lock:
+            if player and player is not self.player: return
+
+            if self.player:
+                self.player.stop_watching()
+
+            self.player = None
 
     def pairable(self, status: bool) -> None:
 
@@ -125,22 +338,43 @@ class Bluetooth():
     def list_devices(self) -> List[Device]:
         """
         Returns a list of all devices known.
+
+        Is answered by the registry, no command is sent to `bluetoothctl` once it was synced.
         """
 
-        out = self.command('devices')
+        self.ensure_registry()
+
+        return self.registry.list_devices()
+
+    def query_devices(self) -> List[Device]:
+        """
+        Asks `bluetoothctl` for all devices known. Their paired/connected state is not included. Concurrent calls share one query.
+        """
+
+        return self.queries.do('devices', self._query_devices)
+
+    def _query_devices(self) -> List[Device]:
+
+        return self.parse_devices(self.command('devices'))
+
+    def parse_devices(self, out: str) -> List[Device]:
+        """
+        Returns the devices of the output of `devices`.
+        """
 
         devices = list()
 
-        for line in out.split('\n'):
-            if line.startswith('Device'):
-                try:
-                    splitted = line.split(' ')
-                    devices.append(Device(
-                        name=splitted[2],
-                        mac_address=splitted[1],
-                    ))
-                except Exception as e:
-                    self.logger.error('Error while listing devices: %s', e)
+        with parse_seconds.time(query='devices'):
+            for line in out.split('\n'):
+                if line.startswith('Device'):
+                    try:
+                        splitted = line.split(' ', 2)
+                        devices.append(Device(
+                            name=splitted[2],
+                            mac_address=splitted[1],
+                        ))
+                    except Exception as e:
+                        self.logger.error('Error while listing devices: %s', e)
 
         return devices
     
@@ -151,20 +385,21 @@ class Bluetooth():
         command = 'remove ' + mac_address
 
         self.command(command)
+
+        self.queries.forget('devices')
     
     def device_exists(self, mac_address: str) -> bool:
-        devices = self.list_devices()
 
-        for device in devices:
-            if device.mac_address == mac_address: return True
-        
-        return False
+        self.ensure_registry()
+
+        return self.registry.has_device(mac_address)
 
     def clean_up(self):
         """
         Cleans up. Should be called before exiting program or deleting bluetooth instance.
         """
-        pass
+        self.unset_player()
+        self.session.stop()
 
 
 class BluetoothctlNotFoundException(Exception):
@@ -174,3 +409,12 @@ class BluetoothctlNotFoundException(Exception):
 
     def __init__(self, bluetoothctl_name) -> None:
         super().__init__(f'The bluetooth utility was not found: `{bluetoothctl_name}`')
+
+
+class UnknownQueryException(Exception):
+    """
+    Is raised when batch_query() is asked for a query that does not exist.
+    """
+
+    def __init__(self, query: str) -> None:
+        super().__init__(f'The query \'{query}\' does not exist, use one of: devices, players, show')
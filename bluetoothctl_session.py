@@ -0,0 +1,306 @@
+import re
+import uuid
+import queue
+import logging
+import subprocess
+from threading import Thread, Lock
+from typing import Callable, List
+
+from metrics import registry
+
+
+# matches color codes and other terminal control sequences bluetoothctl puts into its output
+ansi_escape_regex = re.compile(r'\x1b\[[0-9;?]*[A-Za-z]|\x01|\x02|\r')
+
+# matches the interactive prompt (e.g. '[bluetooth]# ' or '[Phone]# ') at the start of a line
+prompt_regex = re.compile(r'^(\[[^\]]*\][#>] ?)+')
+
+sentinel_prefix = '__dash_sentinel_'
+"""Prefix of the invalid commands used to detect the end of a response. bluetoothctl echoes them in an error line."""
+
+event_prefixes = ('[NEW] ', '[CHG] ', '[DEL] ')
+"""Lines starting with these are events bluetoothctl prints on its own, they are not part of a response."""
+
+async_commands = ('remove', 'pairable', 'discoverable', 'power', 'pair', 'trust', 'untrust', 'connect', 'disconnect', 'play', 'pause', 'stop', 'next', 'previous')
+"""
+Commands bluetoothctl answers asynchronously: it reads the next line before bluez replied,
+so the reply (e.g. 'Device has been removed') would only show up after the sentinel.
+"""
+
+# matches the asynchronous replies, e.g. 'Changing pairable on succeeded', 'Play successful', 'Failed to remove device: ...'
+async_reply_regex = re.compile(r'(succeeded|successful)$|^Successful |has been removed$|^Failed to ')
+
+# matches errors bluetoothctl prints right away, the asynchronous command is not sent to bluez then and there is no reply to wait for
+command_error_regex = re.compile(r'not available$|^Invalid |^Missing |^No default ')
+
+command_seconds = registry.histogram('bluetoothctl_command_seconds', 'Round trip time of a batch of bluetoothctl commands, labeled by the first command.')
+command_errors = registry.counter('bluetoothctl_command_errors_total', 'Batches of bluetoothctl commands that timed out or lost the session.')
+
+
+class BluetoothctlSession():
+    """
+    A long-lived `bluetoothctl` process that commands are sent to.
+
+    Instead of spawning a new process for every call, one interactive session is kept open.
+    Every batch of commands is followed by a unique sentinel command, the response is complete when the sentinel shows up in the output.
+    batch() sends several of these batches at once, so multiple queries only cost one round trip.
+
+    The sentinel only shows that bluetoothctl read all commands. For the `async_commands` it also waits for their reply,
+    so it is not mixed into the output of the next caller. Replies that show up when none is expected
+    (e.g. of a command that timed out) are dropped.
+    Callers are serialized by a lock, so the session can be shared by multiple threads.
+    If the process dies it is respawned on the next call.
+    """
+
+    def __init__(self, bluetoothctl_path: str = 'bluetoothctl', timeout: float = 5.0, on_event: Callable[[str], None] = None, on_start: Callable[[], None] = None, logger: logging.Logger = None) -> None:
+        """
+        :param bluetoothctl_path: The path/name of the `bluetoothctl` program.
+        :param timeout: How many seconds to wait for a response before giving up.
+        :param on_event: Is called from the reader thread with every event line (`[NEW]`, `[CHG]`, `[DEL]`).
+        :param on_start: Is called every time a new process is spawned, before any of its output is read.
+        """
+
+        # if logger is set, use it
+        # if logger is not set a null_logger is created that wont log anything
+        if logger:
+            self.logger = logger
+        else:
+            # create a logger
+            self.logger = logging.getLogger('null_logger')
+
+            # create a NullHandler and add it to the logger
+            null_handler = logging.NullHandler()
+            self.logger.addHandler(null_handler)
+
+            # set the logger level to NOTSET to capture all messages
+            self.logger.setLevel(logging.NOTSET)
+
+        self.bluetoothctl_path = bluetoothctl_path
+        self.timeout = timeout
+        self.on_event = on_event
+        self.on_start = on_start
+
+        self.process: subprocess.Popen = None
+
+        # lines read from stdout of the process, filled by the reader thread
+        # None is put into it when the process closed its stdout
+        self.lines: queue.Queue = None
+
+        # only one batch of commands can be in flight at a time
+        self.lock = Lock()
+
+    def start(self) -> None:
+        """
+        Spawns the `bluetoothctl` process and the thread reading its output.
+
+        Raises FileNotFoundError if there is no program at `bluetoothctl_path`.
+        """
+
+        self.logger.info('Starting bluetoothctl session: \'%s\'', self.bluetoothctl_path)
+
+        self.process = subprocess.Popen(
+            [self.bluetoothctl_path],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            universal_newlines=True,
+            bufsize=1,
+        )
+
+        self.lines = queue.Queue()
+
+        if self.on_start: self.on_start()
+
+        reader_thread = Thread(target=self._read_lines, args=(self.process, self.lines))
+        reader_thread.daemon = True
+        reader_thread.start()
+
+    def is_alive(self) -> bool:
+        return self.process is not None and self.process.poll() is None
+
+    def commands(self, commands: List[str]) -> str:
+        """
+        Executes the list of commands in the session. Returns the output of the commands as string.
+
+        After the commands a `back` is sent, so the next batch starts in the main menu again.
+        If the process died it is respawned and the commands are sent once more.
+        """
+
+        return self.batch([commands])[0]
+
+    def batch(self, queries: List[List[str]]) -> List[str]:
+        """
+        Executes several lists of commands in one round trip. Returns the output of every list, in the same order.
+
+        Every list is followed by a `back` and its own sentinel, so the outputs can be told apart
+        and every list starts in the main menu, like with commands().
+        """
+
+        if len(queries) == 1:
+            # only the command itself, arguments like mac addresses would create a label per device
+            label = queries[0][0].split(' ', 1)[0] if queries[0] else 'none'
+        else:
+            label = 'batch'
+
+        with self.lock, command_seconds.time(command=label):
+            try:
+                return self._execute(queries)
+            except (BrokenPipeError, BluetoothctlSessionClosedException):
+                command_errors.inc(command=label)
+                self.logger.warning('bluetoothctl session died, respawning it.')
+                self.stop()
+                return self._execute(queries)
+            except BluetoothctlTimeoutException:
+                command_errors.inc(command=label)
+                raise
+
+    def command(self, command: str) -> str:
+        """
+        Executes a command in the session. Returns the output of the command as string.
+
+        Uses the commands() method.
+        """
+        return self.commands([command])
+
+    def stop(self) -> None:
+        """
+        Ends the `bluetoothctl` process. The session is started again on the next call of commands().
+        """
+
+        if not self.process: return
+
+        process = self.process
+        self.process = None
+
+        try:
+            if process.poll() is None:
+                process.stdin.write('exit\n')
+                process.stdin.flush()
+                process.wait(timeout=1)
+        except (OSError, ValueError, subprocess.TimeoutExpired):
+            process.kill()
+
+    def _execute(self, queries: List[List[str]]) -> List[str]:
+
+        if not self.is_alive():
+            self.start()
+
+        sentinels = [sentinel_prefix + uuid.uuid4().hex for _ in queries]
+
+        lines_to_send = list()
+
+        # asynchronous commands of every query whose reply did not show up yet
+        pending_replies: List[List[str]] = list()
+
+        for commands, sentinel in zip(queries, sentinels):
+            # 'exit' and 'quit' would end the persistent session, stop() takes care of that
+            commands = [command for command in commands if command not in ('exit', 'quit')]
+
+            for command in commands:
+                self.logger.info('Sending command to bluetoothctl: \'%s\'', command)
+
+            lines_to_send += commands + ['back', sentinel]
+            pending_replies.append([command.split(' ', 1)[0] for command in commands if command.split(' ', 1)[0] in async_commands])
+
+        # lines that came in between two calls belong to nobody, e.g. the late reply of a call that timed out
+        while not self.lines.empty():
+            line = self.lines.get_nowait()
+
+            if line is None:
+                raise BluetoothctlSessionClosedException()
+
+            self.logger.debug('Dropping stray bluetoothctl line: \'%s\'', line)
+
+        self.process.stdin.write('\n'.join(lines_to_send) + '\n')
+        self.process.stdin.flush()
+
+        # output lines of every query, the query at index `current` is the one whose sentinel did not show up yet
+        outputs: List[List[str]] = [list() for _ in queries]
+        current = 0
+
+        # the sentinels show up in the order they were sent, the replies can come after them
+        while current < len(sentinels) or any(pending_replies):
+            try:
+                line = self.lines.get(timeout=self.timeout)
+            except queue.Empty:
+                if current == len(sentinels):
+                    # every command was read, bluez just did not answer, a late reply is dropped as stray
+                    self.logger.warning('bluetoothctl did not reply to an asynchronous command within %s seconds.', self.timeout)
+                    break
+
+                # the session is in an unknown state now, start over on the next call
+                self.stop()
+                raise BluetoothctlTimeoutException(lines_to_send, self.timeout)
+
+            if line is None:
+                raise BluetoothctlSessionClosedException()
+
+            if current < len(sentinels) and sentinels[current] in line:
+                current += 1
+                continue
+
+            # leftovers of earlier sentinels, bluetoothctl may print them more than once
+            if sentinel_prefix in line:
+                continue
+
+            if async_reply_regex.search(line):
+                waiting = [(index, command) for index, pending in enumerate(pending_replies) for command in pending]
+
+                if not waiting:
+                    self.logger.debug('Dropping stray bluetoothctl reply: \'%s\'', line)
+                    continue
+
+                # the replies name their command (e.g. 'Play successful', 'Changing pairable on succeeded'), but not always in the order they were sent
+                index, command = next(((index, command) for index, command in waiting if command in line.lower()), waiting[0])
+
+                pending_replies[index].remove(command)
+                outputs[index].append(line)
+                continue
+
+            if current == len(sentinels):
+                self.logger.debug('Dropping stray bluetoothctl line: \'%s\'', line)
+                continue
+
+            # the command failed right away, bluez will not reply to it
+            if pending_replies[current] and command_error_regex.search(line):
+                pending_replies[current].pop(0)
+
+            outputs[current].append(line)
+
+        return ['\n'.join(out_lines) for out_lines in outputs]
+
+    def _read_lines(self, process: subprocess.Popen, lines: queue.Queue) -> None:
+
+        for line in process.stdout:
+            line = ansi_escape_regex.sub('', line).rstrip('\n')
+            line = prompt_regex.sub('', line)
+
+            if line.startswith(event_prefixes):
+                if self.on_event:
+                    try:
+                        self.on_event(line)
+                    except Exception:
+                        self.logger.error('Error while handling bluetoothctl event: \'%s\'', line, exc_info=1)
+                continue
+
+            lines.put(line)
+
+        lines.put(None)
+
+
+class BluetoothctlTimeoutException(Exception):
+    """
+    Is raised when `bluetoothctl` did not finish responding to commands in time.
+    """
+
+    def __init__(self, commands: List[str], timeout: float) -> None:
+        super().__init__(f'bluetoothctl did not respond within {timeout} seconds to: {commands}')
+
+
+class BluetoothctlSessionClosedException(Exception):
+    """
+    Is raised when the `bluetoothctl` process closed its output while waiting for a response.
+    """
+
+    def __init__(self) -> None:
+        super().__init__('The bluetoothctl session was closed.')
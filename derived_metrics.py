@@ -0,0 +1,375 @@
+import logging
+from abc import ABC, abstractmethod
+from collections import deque
+from threading import Lock
+from typing import Callable, Dict, List, Tuple
+
+import yaml
+
+
+default_gear_ratios = [140.0, 75.0, 50.0, 38.0, 30.0, 25.0]
+"""RPM per km/h of every gear, starting with the first. They depend on the car, these fit a typical six-speed gearbox."""
+
+
+class Operator(ABC):
+    """
+    A metric derived from obd samples, e.g. the trip distance from the speed.
+
+    update() is called with every sample of one of the `inputs` and returns the new values of the outputs (or None if there are none).
+    It has to take constant time, operators keep running sums instead of looking at old samples again.
+    """
+
+    inputs: Tuple[str, ...] = ()
+    """Names of the samples the operator needs (e.g. 'speed', 'rpm')."""
+
+    max_gap: float = 5.0
+    """Seconds between two samples after which the time in between is not counted, e.g. because the car was disconnected."""
+
+    @abstractmethod
+    def update(self, name: str, timestamp: float, values: Dict[str, float]) -> Dict[str, float]:
+        """
+        :param name: The name of the new sample.
+        :param values: The latest value of every sample, including the new one.
+        """
+
+    def reset(self) -> None:
+        """
+        Forgets everything, e.g. when a new trip starts.
+        """
+        pass
+
+
+class Acceleration(Operator):
+    """
+    The acceleration in m/s², from the change of the speed over the last `window` seconds.
+    """
+
+    inputs = ('speed',)
+
+    def __init__(self, window: float = 1.0, output: str = 'acceleration') -> None:
+
+        self.window = window
+        self.output = output
+
+        self.reset()
+
+    def reset(self) -> None:
+
+        # (timestamp, speed) of the samples in the window
+        self.samples: deque = deque()
+
+    def update(self, name: str, timestamp: float, values: Dict[str, float]) -> Dict[str, float]:
+
+        if self.samples and timestamp - self.samples[-1][0] > self.max_gap:
+            self.samples.clear()
+
+        self.samples.append((timestamp, values['speed']))
+
+        # every sample is removed once, so this is constant on average
+        while len(self.samples) > 2 and timestamp - self.samples[1][0] >= self.window:
+            self.samples.popleft()
+
+        first_timestamp, first_speed = self.samples[0]
+
+        if timestamp <= first_timestamp: return None
+
+        # km/h -> m/s
+        return { self.output: (values['speed'] - first_speed) / 3.6 / (timestamp - first_timestamp) }
+
+
+class TripDistance(Operator):
+    """
+    The distance driven in km, the integral of the speed over time.
+    """
+
+    inputs = ('speed',)
+
+    def __init__(self, output: str = 'trip_distance') -> None:
+
+        self.output = output
+
+        self.reset()
+
+    def reset(self) -> None:
+
+        self.distance = 0.0
+        self.last: Tuple[float, float] = None
+
+    def update(self, name: str, timestamp: float, values: Dict[str, float]) -> Dict[str, float]:
+
+        speed = values['speed']
+
+        if self.last:
+            last_timestamp, last_speed = self.last
+            duration = timestamp - last_timestamp
+
+            # trapezoid between the two samples, km/h * h
+            if 0 < duration <= self.max_gap:
+                self.distance += (last_speed + speed) / 2 * duration / 3600
+
+        self.last = (timestamp, speed)
+
+        return { self.output: self.distance }
+
+
+class AverageSpeed(Operator):
+    """
+    The average speed in km/h, weighted by time. Over the whole trip, or over the last `window` seconds if it is set.
+    """
+
+    inputs = ('speed',)
+
+    def __init__(self, window: float = None, output: str = 'average_speed') -> None:
+
+        self.window = window
+        self.output = output
+
+        self.reset()
+
+    def reset(self) -> None:
+
+        self.area = 0.0
+        self.duration = 0.0
+        self.last: Tuple[float, float] = None
+
+        # (end timestamp, duration, area) of the segments in the window
+        self.segments: deque = deque()
+
+    def update(self, name: str, timestamp: float, values: Dict[str, float]) -> Dict[str, float]:
+
+        speed = values['speed']
+
+        if self.last:
+            last_timestamp, last_speed = self.last
+            duration = timestamp - last_timestamp
+
+            if 0 < duration <= self.max_gap:
+                area = (last_speed + speed) / 2 * duration
+
+                self.area += area
+                self.duration += duration
+
+                if self.window: self.segments.append((timestamp, duration, area))
+
+        self.last = (timestamp, speed)
+
+        # segments leave the window in the order they came in
+        while self.segments and timestamp - self.segments[0][0] > self.window:
+            _, duration, area = self.segments.popleft()
+
+            self.area -= area
+            self.duration -= duration
+
+        if self.duration <= 0: return None
+
+        return { self.output: self.area / self.duration }
+
+
+class IdleTime(Operator):
+    """
+    Seconds the engine was running while the car did not move.
+    """
+
+    inputs = ('speed', 'rpm')
+
+    def __init__(self, max_idle_speed: float = 1.0, output: str = 'idle_time') -> None:
+
+        self.max_idle_speed = max_idle_speed
+        self.output = output
+
+        self.reset()
+
+    def reset(self) -> None:
+
+        self.idle_time = 0.0
+        self.last_timestamp: float = None
+        self.idle = False
+
+    def update(self, name: str, timestamp: float, values: Dict[str, float]) -> Dict[str, float]:
+
+        # the state since the last sample decides if the time in between was idle
+        if self.idle and self.last_timestamp is not None and 0 < timestamp - self.last_timestamp <= self.max_gap:
+            self.idle_time += timestamp - self.last_timestamp
+
+        self.last_timestamp = timestamp
+        self.idle = values.get('speed', 0) < self.max_idle_speed and values.get('rpm', 0) > 0
+
+        return { self.output: self.idle_time }
+
+
+class Gear(Operator):
+    """
+    The estimated gear from the ratio of rpm to speed, 0 if no gear fits (standing, clutch pressed, neutral).
+
+    A new gear is only taken over when it was detected in `confirm_samples` samples in a row,
+    so shifting and short slips of the clutch do not make the value jump back and forth.
+    """
+
+    inputs = ('speed', 'rpm')
+
+    def __init__(self, ratios: List[float] = None, tolerance: float = 0.12, confirm_samples: int = 3, min_speed: float = 5.0, output: str = 'gear') -> None:
+        """
+        :param ratios: RPM per km/h of every gear, starting with the first.
+        :param tolerance: How far (as fraction) the ratio can be off the ratio of a gear to still count as that gear.
+        :param min_speed: Below this speed (km/h) no gear is detected.
+        """
+
+        self.ratios = ratios or default_gear_ratios
+        self.tolerance = tolerance
+        self.confirm_samples = confirm_samples
+        self.min_speed = min_speed
+        self.output = output
+
+        self.reset()
+
+    def reset(self) -> None:
+
+        self.gear = 0
+
+        self.candidate = 0
+        self.candidate_count = 0
+
+    def detect(self, speed: float, rpm: float) -> int:
+        """
+        Returns the gear whose ratio is closest to rpm/speed, or 0 if none is within the tolerance.
+        """
+
+        if speed < self.min_speed or rpm <= 0: return 0
+
+        ratio = rpm / speed
+
+        gear, gear_ratio = min(enumerate(self.ratios, start=1), key=lambda gear_and_ratio: abs(gear_and_ratio[1] - ratio))
+
+        return gear if abs(ratio - gear_ratio) <= gear_ratio * self.tolerance else 0
+
+    def update(self, name: str, timestamp: float, values: Dict[str, float]) -> Dict[str, float]:
+
+        if 'speed' not in values or 'rpm' not in values: return None
+
+        detected = self.detect(values['speed'], values['rpm'])
+
+        if detected == self.gear:
+            self.candidate_count = 0
+        elif detected == self.candidate:
+            self.candidate_count += 1
+        else:
+            self.candidate = detected
+            self.candidate_count = 1
+
+        if self.candidate_count >= self.confirm_samples:
+            self.gear = self.candidate
+            self.candidate_count = 0
+
+        return { self.output: self.gear }
+
+
+def default_operators(gear_ratios: List[float] = None) -> List[Operator]:
+    """
+    Acceleration, estimated gear, trip distance, average speed of the trip and of the last minute and idle time.
+    """
+
+    return [
+        Acceleration(),
+        Gear(gear_ratios),
+        TripDistance(),
+        AverageSpeed(),
+        AverageSpeed(window=60, output='average_speed_1m'),
+        IdleTime(),
+    ]
+
+
+def load_derived_config(config_path: str) -> List[Operator]:
+    """
+    Creates the default operators with the settings from the `derived` section of a yaml file like this:
+
+        derived:
+          gear_ratios: [140, 75, 50, 38, 30, 25]
+
+    The defaults are used if the file or the section does not exist.
+    """
+
+    try:
+        with open(config_path) as config_file:
+            config = yaml.safe_load(config_file) or dict()
+    except FileNotFoundError:
+        config = dict()
+
+    derived_config = config.get('derived') or dict()
+
+    gear_ratios = derived_config.get('gear_ratios')
+
+    return default_operators([float(ratio) for ratio in gear_ratios] if gear_ratios else None)
+
+
+class DerivedMetrics():
+    """
+    Feeds the obd samples to operators and publishes their outputs as new samples (e.g. 'gear', 'trip_distance').
+
+    New metrics are added by writing an Operator and passing it in `operators`.
+    """
+
+    def __init__(self, operators: List[Operator], publish: Callable[[str, float, float], None], logger: logging.Logger = None) -> None:
+        """
+        :param publish: Is called with the name, timestamp and value of every output.
+        """
+
+        # if logger is set, use it
+        # if logger is not set a null_logger is created that wont log anything
+        if logger:
+            self.logger = logger
+        else:
+            # create a logger
+            self.logger = logging.getLogger('null_logger')
+
+            # create a NullHandler and add it to the logger
+            null_handler = logging.NullHandler()
+            self.logger.addHandler(null_handler)
+
+            # set the logger level to NOTSET to capture all messages
+            self.logger.setLevel(logging.NOTSET)
+
+        self.operators = operators
+        self.publish = publish
+
+        self.lock = Lock()
+
+        self.values: Dict[str, float] = dict()
+        """Latest value of every sample."""
+
+        # only the operators that need a sample are called for it
+        self.operators_by_input: Dict[str, List[Operator]] = dict()
+
+        for operator in operators:
+            for name in operator.inputs:
+                self.operators_by_input.setdefault(name, []).append(operator)
+
+    def handle_sample(self, name: str, timestamp: float, value: float) -> None:
+
+        operators = self.operators_by_input.get(name)
+
+        if not operators: return
+
+        outputs = dict()
+
+        with self.lock:
+            self.values[name] = value
+
+            for operator in operators:
+                try:
+                    outputs.update(operator.update(name, timestamp, self.values) or {})
+                except Exception:
+                    self.logger.error('Error in derived metric %s.', type(operator).__name__, exc_info=1)
+
+        for output, output_value in outputs.items():
+            self.publish(output, timestamp, output_value)
+
+    def reset(self) -> None:
+        """
+        Resets all operators, e.g. when a new trip starts.
+        """
+
+        with self.lock:
+            self.values = dict()
+
+            for operator in self.operators:
+                operator.reset()
@@ -1,4 +1,6 @@
 class Device:
-    def __init__(self, name: str, mac_address: str) -> None:
+    def __init__(self, name: str, mac_address: str, connected: bool = False, paired: bool = False) -> None:
         self.name = name
-        self.mac_address = mac_address
\ No newline at end of file
+        self.mac_address = mac_address
+        self.connected = connected
+        self.paired = paired
\ No newline at end of file
@@ -0,0 +1,187 @@
+import logging
+from threading import Thread, Event, current_thread
+from typing import Callable, Dict, Any
+
+try:
+    from jeepney import DBusAddress, MatchRule, MessageType, Properties, message_bus
+    from jeepney.io.blocking import open_dbus_connection
+except ImportError:
+    open_dbus_connection = None
+
+
+bluez_bus_name = 'org.bluez'
+media_player_interface = 'org.bluez.MediaPlayer1'
+
+
+def dbus_available() -> bool:
+    """
+    Returns True/False depending on if the D-Bus library (`jeepney`) is installed.
+    """
+    return open_dbus_connection is not None
+
+
+def unwrap_variants(properties: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    jeepney returns variants as (signature, value) tuples, this strips the signatures (also in nested dictionaries like Track).
+    """
+
+    unwrapped = dict()
+
+    for name, (signature, value) in properties.items():
+        if signature == 'a{sv}':
+            value = unwrap_variants(value)
+
+        unwrapped[name] = value
+
+    return unwrapped
+
+
+class MediaPlayerMonitor():
+    """
+    Listens to `PropertiesChanged` signals of a bluez `MediaPlayer1` object on D-Bus.
+
+    `on_change` is called with the changed properties (e.g. { 'Status': 'playing' }) every time the player reports a change.
+    On start it is called once with all current properties.
+    If the connection to the bus is lost, `on_lost` is called and nothing is reported anymore.
+    """
+
+    def __init__(self, player_path: str, on_change: Callable[[Dict[str, Any]], None], bus: str = 'SYSTEM', timeout: float = 2.0, on_lost: Callable[[], None] = None, logger: logging.Logger = None) -> None:
+        """
+        :param player_path: The D-Bus object path of the player, like bluetoothctl lists it (/org/bluez/hci0/dev_.../player0).
+        :param bus: 'SYSTEM', 'SESSION' or the address of a bus. bluez lives on the system bus.
+        :param timeout: Seconds start() waits for a reply of the bus or of bluez.
+        :param on_lost: Is called from the listening thread when the connection to the bus was lost, not when stop() is called.
+        """
+
+        # if logger is set, use it
+        # if logger is not set a null_logger is created that wont log anything
+        if logger:
+            self.logger = logger
+        else:
+            # create a logger
+            self.logger = logging.getLogger('null_logger')
+
+            # create a NullHandler and add it to the logger
+            null_handler = logging.NullHandler()
+            self.logger.addHandler(null_handler)
+
+            # set the logger level to NOTSET to capture all messages
+            self.logger.setLevel(logging.NOTSET)
+
+        if not dbus_available():
+            raise DBusNotAvailableException()
+
+        self.player_path = player_path
+        self.on_change = on_change
+        self.bus = bus
+        self.timeout = timeout
+        self.on_lost = on_lost
+
+        self.connection = None
+
+        self.stop_event = Event()
+        self.thread: Thread = None
+
+    def start(self) -> None:
+        """
+        Connects to the bus, reports the current properties and starts a thread that listens for changes.
+
+        Raises an exception if the bus can not be reached or the player does not exist on it.
+        Raises TimeoutError if the bus or bluez do not reply within `timeout` seconds, e.g. because bluez stalls.
+        """
+
+        self.connection = open_dbus_connection(bus=self.bus)
+
+        try:
+            self._subscribe()
+        except Exception:
+            self.close()
+            raise
+
+        self.thread = Thread(target=self._listen)
+        self.thread.daemon = True
+        self.thread.start()
+
+        self.logger.info('Listening to D-Bus changes of player \'%s\'', self.player_path)
+
+    def _subscribe(self) -> None:
+
+        rule = MatchRule(
+            type='signal',
+            interface='org.freedesktop.DBus.Properties',
+            member='PropertiesChanged',
+            path=self.player_path,
+        )
+        rule.add_arg_condition(0, media_player_interface)
+
+        self.connection.send_and_get_reply(message_bus.AddMatch(rule), timeout=self.timeout)
+
+        # the filter has to exist before reading the current state, so no change in between is lost
+        self.signals = self.connection.filter(rule)
+
+        player_address = DBusAddress(self.player_path, bus_name=bluez_bus_name, interface=media_player_interface)
+
+        reply = self.connection.send_and_get_reply(Properties(player_address).get_all(), timeout=self.timeout)
+
+        if reply.header.message_type == MessageType.error:
+            raise DBusPlayerNotFoundException(self.player_path, reply.body)
+
+        self.on_change(unwrap_variants(reply.body[0]))
+
+    def stop(self) -> None:
+        """
+        Stops listening and closes the connection to the bus.
+        """
+
+        self.stop_event.set()
+
+        # on_lost can stop the monitor from the listening thread, which can not wait for itself
+        if self.thread and self.thread is not current_thread():
+            self.thread.join(timeout=2)
+
+        self.close()
+
+    def close(self) -> None:
+
+        if self.connection:
+            self.connection.close()
+            self.connection = None
+
+    def _listen(self) -> None:
+
+        with self.signals as signals:
+            while not self.stop_event.is_set():
+                try:
+                    message = self.connection.recv_until_filtered(signals, timeout=1)
+                except TimeoutError:
+                    continue
+                except Exception:
+                    if self.stop_event.is_set(): return
+
+                    self.logger.error('Lost D-Bus connection of player \'%s\'', self.player_path, exc_info=1)
+
+                    if self.on_lost: self.on_lost()
+                    return
+
+                interface, changed, invalidated = message.body
+
+                if changed:
+                    self.on_change(unwrap_variants(changed))
+
+
+class DBusNotAvailableException(Exception):
+    """
+    Is raised when a MediaPlayerMonitor is created, but the D-Bus library `jeepney` is not installed.
+    """
+
+    def __init__(self) -> None:
+        super().__init__('The D-Bus library `jeepney` is not installed.')
+
+
+class DBusPlayerNotFoundException(Exception):
+    """
+    Is raised when the player path does not belong to a `MediaPlayer1` object on the bus.
+    """
+
+    def __init__(self, player_path: str, error) -> None:
+        super().__init__(f'The player `{player_path}` was not found on D-Bus: {error}')
@@ -0,0 +1,186 @@
+import time
+from bisect import bisect_left
+from threading import Lock
+from contextlib import contextmanager
+from typing import Dict, List, Tuple
+
+
+default_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+"""Upper bounds in seconds, from sub-millisecond parsing to multi-second subprocess calls."""
+
+
+def format_labels(labels: Tuple[Tuple[str, str], ...], extra: str = '') -> str:
+
+    parts = [f'{name}="{value}"' for name, value in labels]
+
+    if extra: parts.append(extra)
+
+    return '{' + ','.join(parts) + '}' if parts else ''
+
+
+class Counter():
+    """
+    A value that only goes up, e.g. the number of samples received. One value is kept per combination of labels.
+    """
+
+    def __init__(self, name: str, help: str) -> None:
+
+        self.name = name
+        self.help = help
+
+        self.lock = Lock()
+        self.values: Dict[Tuple[Tuple[str, str], ...], float] = dict()
+
+    def inc(self, amount: float = 1, **labels) -> None:
+
+        key = tuple(sorted(labels.items()))
+
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def remove(self, **labels) -> None:
+        """
+        Forgets all values with these labels, e.g. the values of a client that disconnected.
+        """
+
+        with self.lock:
+            for key in [key for key in self.values if set(labels.items()) <= set(key)]:
+                del self.values[key]
+
+    def render(self) -> List[str]:
+
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+
+        with self.lock:
+            for labels, value in self.values.items():
+                lines.append(f'{self.name}{format_labels(labels)} {value}')
+
+        return lines
+
+    def summary(self) -> List[str]:
+
+        with self.lock:
+            return [f'{self.name}{format_labels(labels)}={value:g}' for labels, value in self.values.items()]
+
+
+class Histogram():
+    """
+    Counts observations (e.g. durations in seconds) in fixed buckets. Observing is a binary search and an addition.
+    """
+
+    def __init__(self, name: str, help: str, buckets: Tuple[float, ...] = default_buckets) -> None:
+
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets))
+
+        self.lock = Lock()
+
+        # per combination of labels: [count per bucket (the last one is +Inf), sum, count]
+        self.values: Dict[Tuple[Tuple[str, str], ...], list] = dict()
+
+    def observe(self, value: float, **labels) -> None:
+
+        key = tuple(sorted(labels.items()))
+        bucket = bisect_left(self.buckets, value)
+
+        with self.lock:
+            entry = self.values.get(key)
+
+            if not entry:
+                entry = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+
+            entry[0][bucket] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        Observes how long the block inside of `with histogram.time():` took, in seconds.
+        """
+
+        start = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self) -> List[str]:
+
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+
+        with self.lock:
+            for labels, (bucket_counts, total, count) in self.values.items():
+                cumulative = 0
+
+                for upper_bound, bucket_count in zip(self.buckets + (float('inf'),), bucket_counts):
+                    cumulative += bucket_count
+                    le = '+Inf' if upper_bound == float('inf') else f'{upper_bound:g}'
+                    le_label = 'le="' + le + '"'
+                    lines.append(f'{self.name}_bucket{format_labels(labels, le_label)} {cumulative}')
+
+                lines.append(f'{self.name}_sum{format_labels(labels)} {total}')
+                lines.append(f'{self.name}_count{format_labels(labels)} {count}')
+
+        return lines
+
+    def summary(self) -> List[str]:
+
+        with self.lock:
+            return [f'{self.name}{format_labels(labels)} n={count} avg={total / count * 1000:.2f}ms' for labels, (_, total, count) in self.values.items() if count]
+
+
+class MetricsRegistry():
+    """
+    Holds all metrics and renders them in the Prometheus text format.
+    """
+
+    def __init__(self) -> None:
+
+        self.lock = Lock()
+        self.metrics: Dict[str, object] = dict()
+
+    def counter(self, name: str, help: str) -> Counter:
+        """
+        Returns the counter called `name`, it is created on the first call.
+        """
+
+        with self.lock:
+            if name not in self.metrics:
+                self.metrics[name] = Counter(name, help)
+
+            return self.metrics[name]
+
+    def histogram(self, name: str, help: str, buckets: Tuple[float, ...] = default_buckets) -> Histogram:
+        """
+        Returns the histogram called `name`, it is created on the first call.
+        """
+
+        with self.lock:
+            if name not in self.metrics:
+                self.metrics[name] = Histogram(name, help, buckets)
+
+            return self.metrics[name]
+
+    def render(self) -> str:
+
+        with self.lock:
+            metrics = list(self.metrics.values())
+
+        return '\n'.join(line for metric in metrics for line in metric.render()) + '\n'
+
+    def summary(self) -> str:
+        """
+        A short one-line-per-metric summary for the log.
+        """
+
+        with self.lock:
+            metrics = list(self.metrics.values())
+
+        return '\n'.join(line for metric in metrics for line in metric.summary())
+
+
+registry = MetricsRegistry()
+"""The registry every module adds its metrics to, exposed on /metrics."""
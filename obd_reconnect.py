@@ -0,0 +1,101 @@
+import os
+import json
+import random
+import logging
+from typing import Dict
+
+
+class Backoff():
+    """
+    Exponentially growing delays with jitter, used between reconnection attempts.
+    """
+
+    def __init__(self, initial: float = 1.0, maximum: float = 60.0, factor: float = 2.0, jitter: float = 0.25) -> None:
+        """
+        :param jitter: Every delay is randomly changed by up to this fraction, so retries do not happen in lockstep.
+        """
+
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.jitter = jitter
+
+        self.current = initial
+
+    def next(self) -> float:
+        """
+        Returns the next delay in seconds and grows the delay for the call after that.
+        """
+
+        delay = self.current * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+        self.current = min(self.current * self.factor, self.maximum)
+
+        return delay
+
+    def reset(self) -> None:
+        self.current = self.initial
+
+
+class AdapterCache():
+    """
+    Remembers the port and protocol of the last working obd connection in a json file, so they survive restarts.
+    """
+
+    def __init__(self, cache_path: str, logger: logging.Logger = None) -> None:
+
+        # if logger is set, use it
+        # if logger is not set a null_logger is created that wont log anything
+        if logger:
+            self.logger = logger
+        else:
+            # create a logger
+            self.logger = logging.getLogger('null_logger')
+
+            # create a NullHandler and add it to the logger
+            null_handler = logging.NullHandler()
+            self.logger.addHandler(null_handler)
+
+            # set the logger level to NOTSET to capture all messages
+            self.logger.setLevel(logging.NOTSET)
+
+        self.cache_path = cache_path
+
+        self.port: str = None
+        self.protocol: str = None
+
+        self.load()
+
+    def load(self) -> None:
+
+        try:
+            with open(self.cache_path) as cache_file:
+                cache: Dict[str, str] = json.load(cache_file)
+        except (OSError, ValueError):
+            return
+
+        self.port = cache.get('port')
+        self.protocol = cache.get('protocol')
+
+        self.logger.info('Loaded cached obd adapter: port \'%s\', protocol \'%s\'', self.port, self.protocol)
+
+    def save(self, port: str, protocol: str) -> None:
+
+        if (port, protocol) == (self.port, self.protocol): return
+
+        self.port = port
+        self.protocol = protocol
+
+        try:
+            with open(self.cache_path + '.tmp', 'w') as cache_file:
+                json.dump({ 'port': port, 'protocol': protocol }, cache_file)
+
+            os.replace(self.cache_path + '.tmp', self.cache_path)
+        except OSError:
+            self.logger.warning('Could not save obd adapter cache to \'%s\'', self.cache_path, exc_info=1)
+
+    def port_exists(self) -> bool:
+        """
+        Returns True/False depending on if the cached port is still present (e.g. /dev/rfcomm0 disappears when the adapter is gone).
+        """
+        return bool(self.port) and os.path.exists(self.port)
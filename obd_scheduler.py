@@ -0,0 +1,330 @@
+import os
+import time
+import logging
+from threading import Thread, Event
+from typing import Callable, Dict, List
+
+import obd
+import yaml
+
+
+adaptive_start_interval = 0.05
+"""Interval an adaptive command with interval 0 starts to grow from, when its value stops changing."""
+
+early_query_interval = 2.0
+"""Minimum seconds between two queries of a slow command that is queried early, because the bus had nothing else to do."""
+
+
+class WatchedCommand():
+    """
+    An obd command that is queried by the ObdScheduler.
+
+    With `max_interval` the interval adapts to the value: while it changes by less than `threshold` per second
+    (e.g. parked or idling) the interval grows up to `max_interval`, as soon as it changes faster it goes back to `interval`.
+    """
+
+    def __init__(self, command: obd.OBDCommand, interval: float = 0, priority: int = 0, max_interval: float = None, threshold: float = 0) -> None:
+        """
+        :param interval: Minimum seconds between two queries. 0 means the command is queried on every poll.
+        :param priority: Decides which command goes first, when multiple slow commands are due at the same time.
+        :param max_interval: Largest interval of an adaptive command. The interval does not adapt if it is None.
+        :param threshold: Change of the value per second (in the unit of the command) from which the value counts as changing.
+        """
+
+        self.command = command
+        self.interval = interval
+        self.priority = priority
+        self.max_interval = max_interval
+        self.threshold = threshold
+
+        self.current_interval = interval
+        """The interval used right now, it only differs from `interval` for adaptive commands."""
+
+        self.next_due = 0.0
+        """Monotonic time when the command should be queried next."""
+
+        self.last_value: float = None
+        self.last_value_time: float = None
+
+        self.last_query: float = None
+        self.average_interval: float = None
+
+    @property
+    def adaptive(self) -> bool:
+        return self.max_interval is not None
+
+    def adapt(self, value: float, now: float) -> None:
+        """
+        Adapts the interval of an adaptive command to how fast `value` changed since the last value.
+        """
+
+        if not self.adaptive: return
+
+        if self.last_value is not None and now > self.last_value_time:
+            change = abs(value - self.last_value) / (now - self.last_value_time)
+
+            if change >= self.threshold:
+                self.current_interval = self.interval
+            else:
+                self.current_interval = min(max(self.current_interval * 1.5, adaptive_start_interval), self.max_interval)
+
+        self.last_value = value
+        self.last_value_time = now
+
+    def queried(self, now: float) -> None:
+        """
+        Is called after every query. Schedules the next one and measures the effective rate.
+        """
+
+        if self.last_query is not None:
+            interval = now - self.last_query
+            self.average_interval = interval if self.average_interval is None else 0.8 * self.average_interval + 0.2 * interval
+
+        self.last_query = now
+        self.next_due = now + self.current_interval
+
+    def rate(self, now: float) -> float:
+        """
+        Returns the queries per second of the last queries, 0 if the command was not queried twice yet.
+        """
+
+        if not self.average_interval: return 0.0
+
+        # a command that stopped being queried should not keep its old rate
+        return 1 / max(self.average_interval, now - self.last_query)
+
+
+def load_watch_config(config_path: str) -> List[WatchedCommand]:
+    """
+    Reads the commands to watch from a yaml file like this:
+
+        watch:
+          - command: RPM
+          - command: FUEL_LEVEL
+            interval: 10
+            priority: 1
+          - command: SPEED
+            max_interval: 1
+            threshold: 2
+
+    `command` is the name of a python-OBD command (`obd.commands.<NAME>`), see WatchedCommand for the other keys.
+    Raises UnknownObdCommandException if a command does not exist.
+    """
+
+    with open(config_path) as config_file:
+        config = yaml.safe_load(config_file) or dict()
+
+    watched_commands = list()
+
+    for entry in config.get('watch', []):
+        name = entry['command'].upper()
+
+        if not obd.commands.has_name(name):
+            raise UnknownObdCommandException(name)
+
+        watched_commands.append(WatchedCommand(
+            obd.commands[name],
+            interval=float(entry.get('interval', 0)),
+            priority=int(entry.get('priority', 0)),
+            max_interval=float(entry['max_interval']) if 'max_interval' in entry else None,
+            threshold=float(entry.get('threshold', 0)),
+        ))
+
+    return watched_commands
+
+
+def load_watched_commands(config_path: str) -> List[WatchedCommand]:
+    """
+    Returns the commands of the obd config at `config_path`, or RPM and SPEED on every poll if there is no config.
+    """
+
+    if os.path.exists(config_path):
+        return load_watch_config(config_path)
+
+    return [WatchedCommand(obd.commands.RPM), WatchedCommand(obd.commands.SPEED)]
+
+
+class ObdScheduler():
+    """
+    Queries watched commands over a synchronous obd connection, each at its own rate.
+
+    python-OBD's `Async` connection queries every watched command in turn, so every command added slows down all others.
+    This scheduler queries the due fast commands (interval 0 or adaptive) on every poll and puts at most one due slow command in between,
+    so the fast commands keep nearly all of the bandwidth.
+    When an adaptive command slowed down and the bus has nothing to do, slow commands (e.g. fuel level, DTCs) are queried early.
+
+    python-OBD keeps the status CAR_CONNECTED when the ignition is turned off, the car just stops answering (NO DATA).
+    If no fast command got an answer for `silent_timeout` seconds, the scheduler stops and calls `on_silent`.
+    """
+
+    def __init__(self, connection: obd.OBD, watched_commands: List[WatchedCommand], callback: Callable[[obd.OBDResponse], None], on_rates: Callable[[Dict[str, float]], None] = None, rates_interval: float = 2.0, on_silent: Callable[[], None] = None, silent_timeout: float = 5.0, logger: logging.Logger = None) -> None:
+        """
+        :param callback: Is called with every response, like the callbacks of `obd.Async.watch()`.
+        :param on_rates: Is called every `rates_interval` seconds with the effective queries per second of every command, by lowercase name.
+        :param on_silent: Is called from the scheduler thread when the car stopped answering, e.g. because the ignition was turned off.
+        :param silent_timeout: Seconds without an answer to a fast command after which the car counts as silent.
+        """
+
+        # if logger is set, use it
+        # if logger is not set a null_logger is created that wont log anything
+        if logger:
+            self.logger = logger
+        else:
+            # create a logger
+            self.logger = logging.getLogger('null_logger')
+
+            # create a NullHandler and add it to the logger
+            null_handler = logging.NullHandler()
+            self.logger.addHandler(null_handler)
+
+            # set the logger level to NOTSET to capture all messages
+            self.logger.setLevel(logging.NOTSET)
+
+        self.connection = connection
+        self.callback = callback
+        self.on_rates = on_rates
+        self.rates_interval = rates_interval
+        self.on_silent = on_silent
+        self.silent_timeout = silent_timeout
+
+        # monotonic time of the last answer to a fast command
+        self.last_answer = 0.0
+
+        self.fast_commands: List[WatchedCommand] = list()
+        self.slow_commands: List[WatchedCommand] = list()
+
+        for watched_command in watched_commands:
+            if not connection.supports(watched_command.command):
+                self.logger.warning('The car does not support the obd command \'%s\', it is not watched.', watched_command.command.name)
+                continue
+
+            watched_command.current_interval = watched_command.interval
+            watched_command.next_due = 0.0
+
+            if watched_command.interval > 0 and not watched_command.adaptive:
+                self.slow_commands.append(watched_command)
+            else:
+                self.fast_commands.append(watched_command)
+
+        self.stop_event = Event()
+        self.thread: Thread = None
+
+    def start(self) -> None:
+
+        self.stop_event.clear()
+        self.last_answer = time.monotonic()
+
+        self.thread = Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self) -> None:
+
+        self.stop_event.set()
+
+        if self.thread:
+            self.thread.join(timeout=2)
+            self.thread = None
+
+    def next_slow_command(self, now: float) -> WatchedCommand:
+        """
+        Returns the slow command that should be queried now or None if none is due.
+        Of all due commands, the one with the highest priority (and then the most overdue) is chosen.
+        """
+
+        due_commands = [watched_command for watched_command in self.slow_commands if watched_command.next_due <= now]
+
+        if not due_commands: return None
+
+        return min(due_commands, key=lambda watched_command: (-watched_command.priority, watched_command.next_due))
+
+    def next_early_command(self, now: float) -> WatchedCommand:
+        """
+        Returns the slow command to query while the bus is idle or None if every one was queried recently.
+        """
+
+        candidates = [watched_command for watched_command in self.slow_commands if watched_command.last_query is None or now - watched_command.last_query >= early_query_interval]
+
+        if not candidates: return None
+
+        return min(candidates, key=lambda watched_command: (-watched_command.priority, watched_command.next_due))
+
+    def rates(self) -> Dict[str, float]:
+        """
+        Returns the effective queries per second of every command, by lowercase name (e.g. 'rpm').
+        """
+
+        now = time.monotonic()
+
+        return { watched_command.command.name.lower(): round(watched_command.rate(now), 2) for watched_command in self.fast_commands + self.slow_commands }
+
+    def _query(self, watched_command: WatchedCommand) -> None:
+
+        response = self.connection.query(watched_command.command)
+
+        now = time.monotonic()
+
+        # only numeric values can adapt the interval, e.g. the trouble codes are a list
+        if not response.is_null() and hasattr(response.value, 'magnitude'):
+            watched_command.adapt(response.value.magnitude, now)
+
+        watched_command.queried(now)
+
+        if not response.is_null() and watched_command in self.fast_commands:
+            self.last_answer = now
+
+        try:
+            self.callback(response)
+        except Exception:
+            self.logger.error('Error in callback of obd command \'%s\'', watched_command.command.name, exc_info=1)
+
+    def _run(self) -> None:
+
+        next_rates = time.monotonic() + self.rates_interval
+
+        while not self.stop_event.is_set():
+            now = time.monotonic()
+            queried = False
+
+            for watched_command in self.fast_commands:
+                if watched_command.next_due <= now:
+                    self._query(watched_command)
+                    queried = True
+
+            if self.on_silent and self.fast_commands and time.monotonic() - self.last_answer > self.silent_timeout:
+                self.logger.info('The car did not answer for %s seconds, stopping the scheduler.', self.silent_timeout)
+
+                try:
+                    self.on_silent()
+                except Exception:
+                    self.logger.error('Error in silent callback.', exc_info=1)
+
+                return
+
+            now = time.monotonic()
+            slow_command = self.next_slow_command(now) or (None if queried else self.next_early_command(now))
+
+            if slow_command:
+                self._query(slow_command)
+
+            elif not queried:
+                # nothing to do until the next command is due
+                next_due = min((watched_command.next_due for watched_command in self.fast_commands + self.slow_commands), default=now + 1)
+                self.stop_event.wait(max(min(next_due, next_rates) - now, 0))
+
+            if self.on_rates and time.monotonic() >= next_rates:
+                next_rates = time.monotonic() + self.rates_interval
+
+                try:
+                    self.on_rates(self.rates())
+                except Exception:
+                    self.logger.error('Error in rates callback.', exc_info=1)
+
+
+class UnknownObdCommandException(Exception):
+    """
+    Is raised when the watch config contains a command python-OBD does not know.
+    """
+
+    def __init__(self, command_name: str) -> None:
+        super().__init__(f'The obd command `{command_name}` does not exist.')
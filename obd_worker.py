@@ -0,0 +1,371 @@
+"""
+Runs the obd connection in its own process, so the GIL of the web server does not delay the samples.
+
+The worker writes the samples into a SampleRing in shared memory, the server reads them from there.
+Everything else (status, connect, disconnect, rates) is sent as json lines on stdout of the worker.
+
+usage (started by ObdWorkerSource): python obd_worker.py --ring <shared memory name> --capacity 8192 --source obd --config obd_config.yaml
+"""
+
+import sys
+import json
+import time
+import signal
+import struct
+import logging
+import argparse
+import subprocess
+from threading import Thread, Event
+from multiprocessing import shared_memory, resource_tracker
+from typing import Callable, Dict, List, Tuple
+
+from metrics import registry
+from obd_reconnect import Backoff
+from obd_scheduler import load_watched_commands
+from telemetry_source import TelemetrySource, ObdSource, SyntheticSource
+
+
+index_struct = struct.Struct('<Q')
+"""The header are two of these: the write index (number of samples written so far) and the number of names."""
+
+header_size = 2 * index_struct.size
+
+slot_struct = struct.Struct('<ddI4x')
+"""timestamp, value, name id"""
+
+name_size = 32
+"""Bytes per name in the name table."""
+
+restarts_total = registry.counter('obd_worker_restarts_total', 'Restarts of the obd worker process, labeled by reason.')
+dropped_samples_total = registry.counter('obd_worker_dropped_samples_total', 'Samples the worker wrote faster than the server read them.')
+
+
+class SampleRing():
+    """
+    A ring buffer of samples in shared memory, written by one process and read by another without any lock.
+
+    Layout: header, name table (`max_names` names of `name_size` bytes), `capacity` slots.
+    The writer fills a slot and increments the write index after that, so the reader only sees complete slots.
+    If the writer is more than `capacity` samples ahead, the reader skips the overwritten ones and counts them as dropped.
+    A name is put into the name table before the first sample using it is written.
+    """
+
+    def __init__(self, name: str = None, capacity: int = 8192, max_names: int = 64) -> None:
+        """
+        :param name: Name of an existing ring to attach to. A new ring is created if it is None.
+        """
+
+        self.capacity = capacity
+        self.max_names = max_names
+
+        self.names_offset = header_size
+        self.slots_offset = self.names_offset + max_names * name_size
+
+        size = self.slots_offset + capacity * slot_struct.size
+
+        if name:
+            self.memory = shared_memory.SharedMemory(name)
+
+            # only the creator may remove the memory, python would remove it when the attaching process exits
+            resource_tracker.unregister(self.memory._name, 'shared_memory')
+        else:
+            self.memory = shared_memory.SharedMemory(create=True, size=size)
+            self.memory.buf[:header_size] = bytes(header_size)
+
+        self.name = self.memory.name
+        self.owner = not name
+
+        # writer state
+        self.name_ids = dict()
+        self.write_index = 0
+
+        # reader state
+        self.names: List[str] = list()
+        self.read_index = 0
+
+    def write(self, name: str, timestamp: float, value: float) -> None:
+        """
+        Appends a sample. Must only be called by one process.
+        """
+
+        name_id = self.name_ids.get(name)
+
+        if name_id is None:
+            name_id = len(self.name_ids)
+
+            if name_id >= self.max_names: return
+
+            self.memory.buf[self.names_offset + name_id * name_size:self.names_offset + (name_id + 1) * name_size] = name.encode()[:name_size].ljust(name_size, b'\0')
+            self.name_ids[name] = name_id
+
+            # the name is published before any sample uses it
+            index_struct.pack_into(self.memory.buf, index_struct.size, len(self.name_ids))
+
+        slot_struct.pack_into(self.memory.buf, self.slots_offset + (self.write_index % self.capacity) * slot_struct.size, timestamp, value, name_id)
+
+        self.write_index += 1
+
+        # publishes the slot
+        index_struct.pack_into(self.memory.buf, 0, self.write_index)
+
+    def read(self) -> List[Tuple[str, float, float]]:
+        """
+        Returns the samples written since the last call as (name, timestamp, value). Must only be called by one process.
+        """
+
+        # the write index is read first, all names its samples use are published already
+        write_index, = index_struct.unpack_from(self.memory.buf, 0)
+        name_count, = index_struct.unpack_from(self.memory.buf, index_struct.size)
+
+        while len(self.names) < name_count:
+            offset = self.names_offset + len(self.names) * name_size
+            self.names.append(bytes(self.memory.buf[offset:offset + name_size]).rstrip(b'\0').decode())
+
+        if write_index - self.read_index > self.capacity:
+            dropped_samples_total.inc(write_index - self.read_index - self.capacity)
+            self.read_index = write_index - self.capacity
+
+        samples = list()
+
+        for index in range(self.read_index, write_index):
+            timestamp, value, name_id = slot_struct.unpack_from(self.memory.buf, self.slots_offset + (index % self.capacity) * slot_struct.size)
+            samples.append((self.names[name_id], timestamp, value))
+
+        # slots the writer overwrote while they were read are not valid
+        # the slot of sample `new_write_index` is being written right now, it is the slot of sample `new_write_index - capacity`,
+        # so only samples from `new_write_index - capacity + 1` on are complete
+        new_write_index, = index_struct.unpack_from(self.memory.buf, 0)
+        overwritten = new_write_index - self.capacity + 1 - self.read_index
+
+        if overwritten > 0:
+            dropped_samples_total.inc(min(overwritten, len(samples)))
+            samples = samples[overwritten:]
+
+        self.read_index = write_index
+
+        return samples
+
+    def close(self) -> None:
+        """
+        Detaches from the memory, the creator also removes it.
+        """
+
+        self.memory.close()
+
+        if self.owner: self.memory.unlink()
+
+
+class ObdWorkerSource(TelemetrySource):
+    """
+    A telemetry source that runs the obd connection in a worker process (see the top of this file) and supervises it.
+
+    The worker is restarted with backoff when it exits, and killed and restarted when the car is connected
+    but no sample arrived for `stall_timeout` seconds, e.g. because the serial link wedged.
+    """
+
+    def __init__(self, on_sample: Callable[[str, float, float], None], worker_args: List[str], capacity: int = 8192, stall_timeout: float = 10.0, poll_interval: float = 0.02, on_connect: Callable[[], None] = None, on_disconnect: Callable[[], None] = None, on_rates: Callable[[Dict[str, float]], None] = None, on_status: Callable[[str], None] = None, on_ready: Callable[[str], None] = None, logger: logging.Logger = None) -> None:
+        """
+        :param worker_args: Arguments of the worker, e.g. ['--source', 'obd', '--config', 'obd_config.yaml'].
+        :param capacity: Samples the ring buffer holds.
+        :param poll_interval: Seconds between two reads of the ring buffer.
+        """
+
+        super().__init__(on_sample, on_status=on_status, on_ready=on_ready, logger=logger)
+
+        self.worker_args = worker_args
+        self.capacity = capacity
+        self.stall_timeout = stall_timeout
+        self.poll_interval = poll_interval
+
+        self.on_connect = on_connect or (lambda: None)
+        self.on_disconnect = on_disconnect or (lambda: None)
+        self.on_rates = on_rates or (lambda rates: None)
+
+        self.ring: SampleRing = None
+        self.process: subprocess.Popen = None
+
+        self.backoff = Backoff()
+
+        self.ready = False
+        self.car_connected = False
+
+        # monotonic time of the last sample, or of the connect if there was none since
+        self.last_sample = 0.0
+
+    def start_worker(self) -> None:
+
+        self.logger.info('Starting obd worker process.')
+
+        self.process = subprocess.Popen(
+            [sys.executable, __file__, '--ring', self.ring.name, '--capacity', str(self.capacity)] + self.worker_args,
+            stdout=subprocess.PIPE,
+            universal_newlines=True,
+            bufsize=1,
+        )
+
+        reader_thread = Thread(target=self._read_messages, args=(self.process,))
+        reader_thread.daemon = True
+        reader_thread.start()
+
+    def stop_worker(self) -> None:
+
+        if not self.process: return
+
+        process = self.process
+        self.process = None
+
+        if process.poll() is None:
+            process.terminate()
+
+            try:
+                process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+
+        if self.car_connected:
+            self.car_connected = False
+            self.on_disconnect()
+
+    def run(self, stop_event: Event) -> None:
+        """
+        Starts the worker and passes the samples it writes on to `on_sample` until `stop_event` is set.
+        """
+
+        self.ring = SampleRing(capacity=self.capacity)
+
+        self.on_status('Starting obd worker')
+
+        restart_at = 0.0
+
+        try:
+            while not stop_event.is_set():
+
+                if not self.process and time.monotonic() >= restart_at:
+                    self.start_worker()
+
+                for name, timestamp, value in self.ring.read():
+                    self.last_sample = time.monotonic()
+                    self.on_sample(name, timestamp, value)
+
+                if self.process and self.process.poll() is not None:
+                    self.logger.error('The obd worker exited with code %s.', self.process.returncode)
+                    restarts_total.inc(reason='exited')
+
+                    self.stop_worker()
+                    restart_at = time.monotonic() + self.backoff.next()
+
+                elif self.car_connected and time.monotonic() - self.last_sample > self.stall_timeout:
+                    self.logger.error('No samples from the obd worker for %s seconds, restarting it.', self.stall_timeout)
+                    restarts_total.inc(reason='stalled')
+
+                    self.stop_worker()
+                    restart_at = time.monotonic() + self.backoff.next()
+
+                elif self.car_connected:
+                    self.backoff.reset()
+
+                stop_event.wait(self.poll_interval)
+        finally:
+            self.stop_worker()
+            self.ring.close()
+
+    def close(self) -> None:
+        self.stop_worker()
+
+    def _read_messages(self, process: subprocess.Popen) -> None:
+
+        for line in process.stdout:
+            try:
+                message = json.loads(line)
+            except ValueError:
+                continue
+
+            # messages of a worker that was replaced in the meantime are ignored
+            if process is not self.process: continue
+
+            event = message.get('event')
+
+            if event == 'status':
+                self.on_status(message['message'])
+
+            elif event == 'ready' and not self.ready:
+                self.ready = True
+                self.on_ready(message['message'])
+
+            elif event == 'connect':
+                self.car_connected = True
+                self.last_sample = time.monotonic()
+                self.on_connect()
+
+            elif event == 'rates':
+                self.on_rates(message['rates'])
+
+            elif event == 'disconnect' and self.car_connected:
+                self.car_connected = False
+                self.on_disconnect()
+
+
+def send_message(event: str, **data) -> None:
+    """
+    Sends a message of the worker to the server.
+    """
+
+    print(json.dumps({ 'event': event, **data }), flush=True)
+
+
+def main() -> None:
+
+    parser = argparse.ArgumentParser(description='Reads the obd adapter and writes the samples into shared memory.')
+    parser.add_argument('--ring', required=True, help='name of the shared memory of the SampleRing')
+    parser.add_argument('--capacity', type=int, default=8192)
+    parser.add_argument('--source', choices=['obd', 'synthetic'], default='obd')
+    parser.add_argument('--config', default='obd_config.yaml', help='obd config with the watched commands')
+    parser.add_argument('--serial-name', default='serial', help='a part of the name of the serial port of the adapter')
+    parser.add_argument('--cache-path', default=None, help='where the port and protocol of the last connection are cached')
+    parser.add_argument('--pid-count', type=int, default=2, help='commands of the synthetic source')
+    parser.add_argument('--sample-rate', type=float, default=10, help='samples per second of the synthetic source')
+    args = parser.parse_args()
+
+    # stdout is used for the messages, so the log goes to stderr
+    log_handler = logging.StreamHandler(sys.stderr)
+    log_handler.setFormatter(logging.Formatter('[%(asctime)s] %(levelname)s: obd worker: %(message)s', datefmt='%d/%b/%Y %H:%M:%S'))
+
+    logger = logging.getLogger('obd_worker')
+    logger.addHandler(log_handler)
+    logger.setLevel(logging.DEBUG)
+
+    ring = SampleRing(args.ring, capacity=args.capacity)
+
+    callbacks = {
+        'on_status': lambda message: send_message('status', message=message),
+        'on_ready': lambda message: send_message('ready', message=message),
+        'logger': logger,
+    }
+
+    if args.source == 'synthetic':
+        source = SyntheticSource(ring.write, pid_count=args.pid_count, sample_rate=args.sample_rate, **callbacks)
+    else:
+        source = ObdSource(
+            ring.write,
+            load_watched_commands(args.config),
+            adapter_serial_name=args.serial_name,
+            cache_path=args.cache_path,
+            on_connect=lambda: send_message('connect'),
+            on_disconnect=lambda: send_message('disconnect'),
+            on_rates=lambda rates: send_message('rates', rates=rates),
+            **callbacks,
+        )
+
+    stop_event = Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+
+    try:
+        source.run(stop_event)
+    finally:
+        source.close()
+        ring.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+import logging
+from time import sleep
+from collections import deque
+from threading import Lock, Event
+from typing import Callable, Dict, List, Tuple
+
+from metrics import registry
+
+
+dropped_total = registry.counter('outbound_dropped_total', 'Ordered messages dropped because the queue of a client was full, labeled by client and event.')
+coalesced_total = registry.counter('outbound_coalesced_total', 'Latest-value messages replaced by a newer one before they were sent, labeled by client and event.')
+
+
+class ClientQueue():
+    """
+    The messages waiting to be sent to one websocket client.
+
+    Latest-value messages (e.g. telemetry frames) replace an unsent older message with the same key, so a slow client gets the newest value instead of a backlog.
+    Ordered messages (e.g. player changes, status) are sent in order, if more than `max_events` are waiting the oldest one is dropped.
+
+    run() sends the messages. While the transport of the client has more than `max_backlog` messages it did not write yet,
+    nothing is handed to it, so new messages collapse in this queue instead of piling up in the transport.
+    """
+
+    def __init__(self, sid: str, send: Callable[[str, str], None], backlog: Callable[[], int] = None, max_events: int = 50, max_backlog: int = 4, logger: logging.Logger = None) -> None:
+        """
+        :param sid: The socket.io session id of the client.
+        :param send: Is called with event and data of every message, it has to send it to the client.
+        :param backlog: Returns how many messages the transport of the client has not written yet. The backlog is not checked if it is not set.
+        :param max_events: Maximum number of ordered messages waiting.
+        :param max_backlog: Maximum number of messages the transport may have waiting before sending pauses.
+        """
+
+        # if logger is set, use it
+        # if logger is not set a null_logger is created that wont log anything
+        if logger:
+            self.logger = logger
+        else:
+            # create a logger
+            self.logger = logging.getLogger('null_logger')
+
+            # create a NullHandler and add it to the logger
+            null_handler = logging.NullHandler()
+            self.logger.addHandler(null_handler)
+
+            # set the logger level to NOTSET to capture all messages
+            self.logger.setLevel(logging.NOTSET)
+
+        self.sid = sid
+        self.send = send
+        self.backlog = backlog
+        self.max_events = max_events
+        self.max_backlog = max_backlog
+
+        self.lock = Lock()
+
+        self.events: deque = deque()
+        """Ordered messages as (event, data)."""
+
+        self.latest: Dict[str, Tuple[str, str]] = dict()
+        """Latest-value messages as (event, data) by key."""
+
+        self.wakeup = Event()
+        self.closed = False
+
+    def put(self, event: str, data: str) -> None:
+        """
+        Queues an ordered message.
+        """
+
+        with self.lock:
+            if len(self.events) >= self.max_events:
+                dropped_event, _ = self.events.popleft()
+                dropped_total.inc(client=self.sid, event=dropped_event)
+
+            self.events.append((event, data))
+
+        self.wakeup.set()
+
+    def put_latest(self, key: str, event: str, data: str) -> None:
+        """
+        Queues a message that replaces the waiting message with the same `key`.
+        """
+
+        with self.lock:
+            if key in self.latest:
+                coalesced_total.inc(client=self.sid, event=event)
+
+            self.latest[key] = (event, data)
+
+        self.wakeup.set()
+
+    def close(self) -> None:
+        """
+        Stops run(), waiting messages are thrown away.
+        """
+
+        self.closed = True
+        self.wakeup.set()
+
+        dropped_total.remove(client=self.sid)
+        coalesced_total.remove(client=self.sid)
+
+    def run(self) -> None:
+        """
+        Sends the queued messages until close() is called. Ordered messages are sent before latest-value messages.
+        """
+
+        while not self.closed:
+            self.wakeup.wait()
+
+            # let the transport catch up, meanwhile latest-value messages are replaced instead of queued behind each other
+            while self.backlog and self.backlog() > self.max_backlog and not self.closed:
+                sleep(0.02)
+
+            with self.lock:
+                messages: List[Tuple[str, str]] = list(self.events) + list(self.latest.values())
+
+                self.events.clear()
+                self.latest = dict()
+                self.wakeup.clear()
+
+            for event, data in messages:
+                if self.closed: return
+
+                try:
+                    self.send(event, data)
+                except Exception:
+                    self.logger.error('Error while sending \'%s\' to client \'%s\'.', event, self.sid, exc_info=1)
+
+
+class OutboundQueues():
+    """
+    One ClientQueue per connected websocket client.
+    """
+
+    def __init__(self, send: Callable[[str, str, str], None], start_task: Callable, backlog: Callable[[str], int] = None, latest_channels: List[str] = None, max_events: int = 50, max_backlog: int = 4, logger: logging.Logger = None) -> None:
+        """
+        :param send: Is called with client, event and data of every message.
+        :param start_task: Starts a function in the background (e.g. `socketio.start_background_task`), every client gets its own sending task.
+        :param backlog: Returns how many messages the transport of a client has not written yet.
+        :param latest_channels: Channels where only the latest message is kept, all other channels are ordered.
+        """
+
+        # if logger is set, use it
+        # if logger is not set a null_logger is created that wont log anything
+        if logger:
+            self.logger = logger
+        else:
+            # create a logger
+            self.logger = logging.getLogger('null_logger')
+
+            # create a NullHandler and add it to the logger
+            null_handler = logging.NullHandler()
+            self.logger.addHandler(null_handler)
+
+            # set the logger level to NOTSET to capture all messages
+            self.logger.setLevel(logging.NOTSET)
+
+        self.send = send
+        self.start_task = start_task
+        self.backlog = backlog
+        self.latest_channels = set(latest_channels or [])
+        self.max_events = max_events
+        self.max_backlog = max_backlog
+
+        self.lock = Lock()
+
+        self.queues: Dict[str, ClientQueue] = dict()
+
+    def add(self, sid: str) -> None:
+        """
+        Creates the queue of the client `sid` and starts sending it.
+        """
+
+        queue = ClientQueue(
+            sid,
+            send=lambda event, data: self.send(sid, event, data),
+            backlog=(lambda: self.backlog(sid)) if self.backlog else None,
+            max_events=self.max_events,
+            max_backlog=self.max_backlog,
+            logger=self.logger,
+        )
+
+        with self.lock:
+            self.queues[sid] = queue
+
+        self.start_task(queue.run)
+
+    def remove(self, sid: str) -> None:
+
+        with self.lock:
+            queue = self.queues.pop(sid, None)
+
+        if queue: queue.close()
+
+    def send_to(self, sids: List[str], channel: str, data: str) -> None:
+        """
+        Queues `data` as `channel` message for the clients `sids`.
+        """
+
+        with self.lock:
+            queues = [self.queues[sid] for sid in sids if sid in self.queues]
+
+        for queue in queues:
+            if channel in self.latest_channels:
+                queue.put_latest(channel, channel, data)
+            else:
+                queue.put(channel, data)
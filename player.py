@@ -1,13 +1,52 @@
 import json
 import logging
-import subprocess
 from time import sleep
-from typing import Callable, List
+from threading import Thread, Lock
+from typing import Callable, List, Dict, Any
+
+from metrics import registry
+from volume import VolumeController
+from single_flight import SingleFlight
+from media_player_monitor import MediaPlayerMonitor, dbus_available
 
 
 amixer_module_path = 'amixer'
 """Defines the path/name of the `amixer` program. You should change that to match the name/path of the tool on your system."""
 
+volume_controller: VolumeController = None
+"""Shared by all players, because the volume belongs to the system and not to a player. Created on first use by get_volume_controller()."""
+
+
+def get_volume_controller() -> VolumeController:
+
+    global volume_controller
+
+    if not volume_controller:
+        volume_controller = VolumeController(amixer_module_path)
+
+    return volume_controller
+
+
+parse_seconds = registry.histogram('player_parse_seconds', 'Time spent parsing the output of `show`.')
+
+
+def parse_show(out: str) -> Dict[str, str]:
+    """
+    Returns the properties of the `show` output of a player by name, e.g. { 'Status': 'playing', 'Title': '...', 'Duration': '0x0003a980 (240000)' }.
+    """
+
+    properties = dict()
+
+    with parse_seconds.time():
+        for line in out.split('\n'):
+            line = line.strip()
+
+            if ': ' in line:
+                key, value = line.split(': ', 1)
+                properties[key] = value
+
+    return properties
+
     
 class Player():
     """
@@ -15,12 +54,16 @@ class Player():
     It uses the `bluetoothctl` utility, without it, it will not work at all.
     """
 
-    def __init__(self, bluetoothctl_commands: Callable[[List[str]], str], player_name: str, wait_before_update_time: float = 0.2, logger: logging.Logger = None) -> None:
+    def __init__(self, bluetoothctl_commands: Callable[[List[str]], str], player_name: str, wait_before_update_time: float = 0.2, dbus_bus: str = 'SYSTEM', query_ttl: float = 0.5, properties: Dict[str, str] = None, logger: logging.Logger = None) -> None:
         """
         If `player_name` is not set, it searches for the first player it finds and uses it.
         If it cannot find a player and it has not been set, an exception is raised
 
         :param player_name: The name of the bluez player you want to use.
+        :param dbus_bus: The bus watch() listens on for changes of the player ('SYSTEM', 'SESSION' or an address).
+        :param query_ttl: Seconds the output of `show` and `list` is reused by other callers.
+        :param properties: The `show` output of the player, parsed by parse_show(). If it is set, the caller checked that the player exists already
+            and the player starts with this state, nothing is sent to `bluetoothctl`.
         """
 
         # if logger is set, use it
@@ -48,7 +91,10 @@ class Player():
         The path of the bluez player that should be used underneath.
         """
 
-        if player_name == '' or not self.exists():
+        self.queries = SingleFlight(query_ttl)
+        """The player loop and requests that update the player at the same time share one `show`."""
+
+        if player_name == '' or (properties is None and not self.exists()):
             raise PlayerNotFoundException(player_name)
                 
         self.song = {
@@ -61,10 +107,28 @@ class Player():
         # self.current = 0
 
         self.isPlaying = False
-        self.volume = 0.5
+
+        # position in the current song in seconds, only known when the player is watched over D-Bus
+        self.position = 0
+
+        self.dbus_bus = dbus_bus
+        self.monitor: MediaPlayerMonitor = None
+
+        self.on_change: Callable[[], None] = None
+        """Is called every time the state of the player changed, set by watch()."""
 
         # if None is passed, use 0.2
         self.wait_before_update_time = wait_before_update_time or 0.2
+
+        # actions (play/pause, next, previous) are sent to bluez in the background by `actions_thread`
+        # taps that come in while it is busy are merged into one pending state instead of being queued
+        self.actions_lock = Lock()
+        self.actions_thread: Thread = None
+        self.pending_play: bool = None
+        self.pending_skip = 0
+
+        if properties is not None:
+            self.apply_show(properties)
     
     def commands(self, commands: List[str]) -> str:
         """
@@ -92,48 +156,95 @@ class Player():
 
     def toggle_play(self) -> bool:
         """
-        Toggles playing status und sends the play or pause to bluez player.
-        Calls wait_and_update() afterwards.
+        Toggles playing status und sends the play or pause to bluez player in the background.
+        Returns the new playing status right away, the confirmed state is reported by `on_change`.
         """
 
         self.isPlaying = not self.isPlaying
 
-        if self.isPlaying:
-            self.command('play')
-        else:
-            self.command('pause')
-        
-        # wait for player to update
-        self.wait_and_update(self.wait_before_update_time)
-        
+        self.request_action(play=self.isPlaying)
+
         return self.isPlaying
     
     def previous(self):
         """
-        Sends `previous` command to bluez player.
-        Calls wait_and_update() afterwards.
+        Sends `previous` command to bluez player in the background.
+        Returns the current song right away, the new song is reported by `on_change`.
         """
 
-        self.command('previous')
+        self.request_action(skip=-1)
+
+        return self.song
 
+    def next(self):
+        """
+        Sends `next` command to bluez player in the background.
+        Returns the current song right away, the new song is reported by `on_change`.
+        """
 
-        # wait for player to update
-        self.wait_and_update(self.wait_before_update_time)
+        self.request_action(skip=1)
 
         return self.song
 
-    def next(self):
+    def request_action(self, play: bool = None, skip: int = 0) -> None:
         """
-        Sends `next` command to bluez player.
-        Calls wait_and_update() afterwards.
+        Adds an action to the pending state and starts sending it, if that is not happening already.
+
+        :param play: The playing status the player should have (True: play, False: pause), None to leave it.
+        :param skip: How many songs to skip, negative values go back.
         """
 
-        self.command('next')
+        with self.actions_lock:
+            if play is not None:
+                self.pending_play = play
 
-        # wait for player to update
-        self.wait_and_update(self.wait_before_update_time)
+            self.pending_skip += skip
 
-        return self.song
+            if not self.actions_thread:
+                self.actions_thread = Thread(target=self._send_actions)
+                self.actions_thread.daemon = True
+                self.actions_thread.start()
+
+    def _send_actions(self) -> None:
+        """
+        Sends the pending actions to bluez until there are none left.
+        After the last batch it waits for the player to update and reports the new state with `on_change`.
+        """
+
+        while True:
+            with self.actions_lock:
+                play, skip = self.pending_play, self.pending_skip
+                self.pending_play, self.pending_skip = None, 0
+
+                if play is None and skip == 0:
+                    self.actions_thread = None
+                    return
+
+            commands = ['next' if skip > 0 else 'previous'] * abs(skip)
+
+            if play is not None:
+                commands.append('play' if play else 'pause')
+
+            try:
+                self.commands(commands)
+
+                # the player changed, an update must not get an older `show`
+                self.queries.forget('show')
+
+                # wait for player to update, taps in the meantime are sent together in the next batch
+                sleep(self.wait_before_update_time)
+
+                with self.actions_lock:
+                    if self.pending_play is not None or self.pending_skip != 0: continue
+
+                # a watched player reports its new state over D-Bus by itself
+                if not self.monitor:
+                    self.update()
+
+                    if self.on_change: self.on_change()
+
+            except Exception:
+                self.logger.error('Error while sending actions to player \'%s\'', self.bluez_player_path, exc_info=1)
 
     # def skip_to(self, percentage: float) -> float:
     #     self.current = self.song['length'] * percentage / 100
@@ -141,12 +252,18 @@ class Player():
 
     #     return self.current
 
-    def set_volume(self, percentage: float) -> None:
-        self.volume = percentage
-
-        percentage_string = str(percentage * 100) + '%'
+    @property
+    def volume(self) -> float:
+        """
+        The volume (0 to 1), cached by the volume controller.
+        """
+        return get_volume_controller().get()
 
-        subprocess.run([amixer_module_path, 'sset', 'Master', percentage_string])
+    def set_volume(self, percentage: float) -> None:
+        """
+        Sets the volume (0 to 1). Returns right away, quick consecutive calls are collapsed into the latest value.
+        """
+        get_volume_controller().set(percentage)
 
     def json_status(self):
         return json.dumps({
@@ -166,34 +283,101 @@ class Player():
 
         self.logger.info('Updating player.')
 
-        out = self.command('show')
+        out = self.queries.do('show', lambda: self.command('show'))
+
+        self.apply_show(parse_show(out))
+
+    def apply_show(self, properties: Dict[str, str]) -> None:
+        """
+        Updates the player from the properties of its `show` output (see parse_show()).
+        """
 
         try:
-            for line in out.split('\n'):
-                line = line.lstrip()
-
-                if line.startswith('Status'):
-                    self.isPlaying = 'playing' == line.split(': ')[1]
-                elif line.startswith('Title'):
-                    self.song['title'] = line.split(': ')[1]
-                elif line.startswith('Artist'):
-                    self.song['interpret'] = line.split(': ')[1]
-                elif line.startswith('Duration'):
-                    self.song['length'] = int(line.split(' ')[2][1:-1]) / 1000
-                else: pass
+            if 'Status' in properties:
+                self.isPlaying = 'playing' == properties['Status']
+            if 'Title' in properties:
+                self.song['title'] = properties['Title']
+            if 'Artist' in properties:
+                self.song['interpret'] = properties['Artist']
+            if 'Duration' in properties:
+                # e.g. '0x0003a980 (240000)', in milliseconds
+                self.song['length'] = int(properties['Duration'].split(' ')[1][1:-1]) / 1000
         except:
             self.logger.error('Error on updating player.', exc_info=1)
 
+    def apply_properties(self, properties: Dict[str, Any]) -> bool:
+        """
+        Updates the player from bluez `MediaPlayer1` properties (Status, Track, Position).
+        Returns True/False depending on if anything changed.
+        """
+
+        old_state = (dict(self.song), self.isPlaying, self.position)
+
+        if 'Status' in properties:
+            self.isPlaying = 'playing' == properties['Status']
+
+        if 'Track' in properties:
+            track = properties['Track']
+
+            self.song['title'] = track.get('Title', '')
+            self.song['interpret'] = track.get('Artist', '')
+            self.song['length'] = track.get('Duration', 0) / 1000
+
+        if 'Position' in properties:
+            self.position = properties['Position'] / 1000
+
+        return old_state != (self.song, self.isPlaying, self.position)
+
+    def watch(self, on_change: Callable[[], None]) -> bool:
+        """
+        Starts listening to changes of the player over D-Bus. `on_change` is called every time the state of the player changed.
+        Returns True if the player is watched, False if D-Bus can not be used. Then update() has to be called to get new data.
+        """
+
+        self.on_change = on_change
+
+        if not dbus_available():
+            self.logger.info('D-Bus is not available, player \'%s\' has to be polled.', self.bluez_player_path)
+            return False
+
+        def handle_properties(properties: Dict[str, Any]) -> None:
+            if self.apply_properties(properties):
+                on_change()
+
+        def handle_lost() -> None:
+            # the player is polled again, on_change wakes up the player loop so it notices right away
+            self.stop_watching()
+            on_change()
+
+        try:
+            self.monitor = MediaPlayerMonitor(self.bluez_player_path, handle_properties, bus=self.dbus_bus, on_lost=handle_lost, logger=self.logger)
+            self.monitor.start()
+        except Exception:
+            self.logger.warning('Could not watch player \'%s\' over D-Bus, falling back to polling.', self.bluez_player_path, exc_info=1)
+            self.monitor = None
+            return False
+
+        return True
+
+    def stop_watching(self) -> None:
+
+        if self.monitor:
+            self.monitor.stop()
+            self.monitor = None
+
     def exists(self) -> bool:
         """
         Returns True/False depending on if the player still exists.
         """
-        return self.bluez_player_path in self.bluetoothctl_commands(['menu player', 'list']).split(' ')
+        out = self.queries.do('list', lambda: self.bluetoothctl_commands(['menu player', 'list']))
+
+        return self.bluez_player_path in out.split(' ')
     
     def clean_up(self):
         """
         Cleans up. Should be called before exiting program or deleting player instance
         """
+        self.stop_watching()
         self.command('exit')
 
 
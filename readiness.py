@@ -0,0 +1,45 @@
+import time
+from threading import Lock
+from typing import Dict, List
+
+
+STARTING = 'starting'
+READY = 'ready'
+FAILED = 'failed'
+
+
+class Readiness():
+    """
+    Keeps track of the state of every subsystem (bluetooth, obd, ...) while the server starts.
+
+    The server accepts clients right away, the subsystems are initialized in the background and report here when they are done.
+    """
+
+    def __init__(self, subsystems: List[str]) -> None:
+
+        self.lock = Lock()
+
+        self.started = time.time()
+
+        self.subsystems: Dict[str, Dict[str, str]] = { subsystem: { 'state': STARTING, 'message': '' } for subsystem in subsystems }
+
+    def set(self, subsystem: str, state: str, message: str = '') -> None:
+
+        with self.lock:
+            self.subsystems[subsystem] = { 'state': state, 'message': message, 'since': round(time.time() - self.started, 3) }
+
+    def is_ready(self) -> bool:
+        """
+        Returns True when every subsystem started successfully.
+        """
+
+        with self.lock:
+            return all(status['state'] == READY for status in self.subsystems.values())
+
+    def to_dict(self) -> Dict:
+
+        with self.lock:
+            return {
+                'uptime': round(time.time() - self.started, 3),
+                'subsystems': { subsystem: dict(status) for subsystem, status in self.subsystems.items() },
+            }
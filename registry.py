@@ -0,0 +1,112 @@
+from threading import Lock
+from typing import Dict, List
+
+from device import Device
+
+
+class BluetoothRegistry():
+    """
+    Keeps the known devices and players in memory.
+
+    It is filled once by a full sync (see `Bluetooth.sync_registry()`) and kept up to date afterwards
+    by the `[NEW]`, `[CHG]` and `[DEL]` event lines `bluetoothctl` prints when something changes.
+    """
+
+    def __init__(self) -> None:
+
+        self.lock = Lock()
+
+        self.devices: Dict[str, Device] = dict()
+        """Known devices by mac address."""
+
+        self.players: Dict[str, None] = dict()
+        """Known player paths, a dictionary is used to keep the order in which they appeared."""
+
+        self.synced = False
+        """Is False until the registry was filled by a full sync, after that the events keep it up to date."""
+
+    def reset(self) -> None:
+        """
+        Forgets everything. Called when a new `bluetoothctl` session is started, because events could have been missed.
+        """
+
+        with self.lock:
+            self.devices = dict()
+            self.players = dict()
+            self.synced = False
+
+    def replace(self, devices: List[Device], players: List[str]) -> None:
+        """
+        Replaces the content of the registry with the result of a full sync.
+        """
+
+        with self.lock:
+            self.devices = { device.mac_address: device for device in devices }
+            self.players = dict.fromkeys(players)
+            self.synced = True
+
+    def handle_event(self, line: str) -> None:
+        """
+        Updates the registry from an event line like `[CHG] Device AA:BB:CC:DD:EE:FF Connected: yes`.
+        Events of other objects (controllers, transports, ...) are ignored.
+        """
+
+        splitted = line.split(' ', 3)
+
+        if len(splitted) < 3: return
+
+        event, object_type, object_id = splitted[:3]
+        rest = splitted[3] if len(splitted) > 3 else ''
+
+        with self.lock:
+            if object_type == 'Device':
+                self._handle_device_event(event, object_id, rest)
+            elif object_type == 'Player':
+                self._handle_player_event(event, object_id)
+
+    def _handle_device_event(self, event: str, mac_address: str, rest: str) -> None:
+
+        if event == '[NEW]':
+            if mac_address not in self.devices:
+                self.devices[mac_address] = Device(name=rest, mac_address=mac_address)
+
+        elif event == '[DEL]':
+            self.devices.pop(mac_address, None)
+
+        elif event == '[CHG]':
+            device = self.devices.get(mac_address)
+
+            if not device or ': ' not in rest: return
+
+            key, value = rest.split(': ', 1)
+
+            if key in ('Name', 'Alias'):
+                device.name = value
+            elif key == 'Connected':
+                device.connected = value == 'yes'
+            elif key == 'Paired':
+                device.paired = value == 'yes'
+
+    def _handle_player_event(self, event: str, player_path: str) -> None:
+
+        if event == '[NEW]':
+            self.players[player_path] = None
+
+        elif event == '[DEL]':
+            self.players.pop(player_path, None)
+
+    def list_devices(self) -> List[Device]:
+
+        with self.lock:
+            return list(self.devices.values())
+
+    def has_device(self, mac_address: str) -> bool:
+        return mac_address in self.devices
+
+    def list_players(self) -> List[str]:
+
+        with self.lock:
+            return list(self.players)
+
+    def has_player(self, player_path: str) -> bool:
+        return player_path in self.players
@@ -0,0 +1,88 @@
+import time
+from threading import Lock, Event
+from typing import Any, Callable, Dict
+
+
+class Call():
+    """
+    One execution of a function, shared by everyone who asked for it while it ran.
+    """
+
+    def __init__(self) -> None:
+
+        self.done = Event()
+
+        self.result: Any = None
+        self.error: BaseException = None
+
+        self.finished: float = None
+        """Monotonic time when the function returned."""
+
+
+class SingleFlight():
+    """
+    Runs a function only once for concurrent callers asking for the same key, they all get the same result.
+
+    E.g. when the player loop and two requests ask for the devices at the same time, `bluetoothctl` is asked once.
+    A result is also reused for `ttl` seconds after it was produced. Errors are passed to every waiting caller, but not reused.
+    """
+
+    def __init__(self, ttl: float = 0.0) -> None:
+        """
+        :param ttl: Seconds a result is reused. 0 only shares results between callers that overlap.
+        """
+
+        self.ttl = ttl
+
+        self.lock = Lock()
+        self.calls: Dict[str, Call] = dict()
+
+    def do(self, key: str, function: Callable[[], Any]) -> Any:
+        """
+        Returns the result of `function`. If a call with the same `key` is running or finished less than `ttl` seconds ago, its result is returned instead.
+        """
+
+        with self.lock:
+            call = self.calls.get(key)
+
+            if call and call.done.is_set() and (call.error or time.monotonic() - call.finished > self.ttl):
+                call = None
+
+            leader = call is None
+
+            if leader:
+                call = self.calls[key] = Call()
+
+        if not leader:
+            call.done.wait()
+
+            if call.error: raise call.error
+
+            return call.result
+
+        try:
+            call.result = function()
+        except BaseException as error:
+            call.error = error
+            raise
+        finally:
+            call.finished = time.monotonic()
+            call.done.set()
+
+            with self.lock:
+                # nothing to reuse, the next caller starts over
+                if call.error and self.calls.get(key) is call: del self.calls[key]
+
+        return call.result
+
+    def forget(self, key: str = None) -> None:
+        """
+        Throws away the stored result of `key` (or of all keys), e.g. because a command changed what it would return.
+        Running calls are not affected.
+        """
+
+        with self.lock:
+            if key is None:
+                self.calls = { key: call for key, call in self.calls.items() if not call.done.is_set() }
+            elif key in self.calls and self.calls[key].done.is_set():
+                del self.calls[key]
@@ -0,0 +1,220 @@
+from abc import ABC, abstractmethod
+from threading import Lock
+from typing import Callable, Dict, Tuple
+
+import yaml
+
+
+class Filter(ABC):
+    """
+    Smooths the samples of one command and estimates how fast the value changes.
+
+    update() is called with every sample and returns the smoothed value and its velocity (change per second),
+    so clients can extrapolate the value between two samples. Every update takes constant time.
+    """
+
+    max_gap: float = 5.0
+    """Seconds between two samples after which the filter starts over instead of smoothing across the gap."""
+
+    @abstractmethod
+    def update(self, timestamp: float, value: float) -> Tuple[float, float]:
+        pass
+
+    def reset(self) -> None:
+        pass
+
+
+class EmaFilter(Filter):
+    """
+    Exponential moving average of the value and of its velocity.
+    """
+
+    def __init__(self, alpha: float = 0.5) -> None:
+        """
+        :param alpha: Weight of a new sample between 0 and 1. Smaller values smooth more, but follow changes later.
+        """
+
+        self.alpha = alpha
+
+        self.reset()
+
+    def reset(self) -> None:
+
+        self.value: float = None
+        self.velocity = 0.0
+        self.timestamp: float = None
+
+    def update(self, timestamp: float, value: float) -> Tuple[float, float]:
+
+        if self.value is None or not 0 < timestamp - self.timestamp <= self.max_gap:
+            self.value = value
+            self.velocity = 0.0
+            self.timestamp = timestamp
+
+            return self.value, self.velocity
+
+        new_value = self.alpha * value + (1 - self.alpha) * self.value
+
+        self.velocity = self.alpha * (new_value - self.value) / (timestamp - self.timestamp) + (1 - self.alpha) * self.velocity
+        self.value = new_value
+        self.timestamp = timestamp
+
+        return self.value, self.velocity
+
+
+class KalmanFilter(Filter):
+    """
+    A 1-D Kalman filter with a constant velocity model. The state is the value and its velocity,
+    changes of the velocity (acceleration) are modeled as white noise.
+    """
+
+    def __init__(self, process_noise: float = 1.0, measurement_noise: float = 1.0) -> None:
+        """
+        :param process_noise: Spectral density of the acceleration (unit²/s³). Larger values follow quick changes faster.
+        :param measurement_noise: Variance of the samples (unit²), e.g. 400 for rpm values that are off by about 20.
+        """
+
+        self.process_noise = process_noise
+        self.measurement_noise = measurement_noise
+
+        self.reset()
+
+    def reset(self) -> None:
+
+        self.value: float = None
+        self.velocity = 0.0
+        self.timestamp: float = None
+
+        # covariance of (value, velocity), it is symmetric
+        self.p00 = self.p01 = self.p11 = 0.0
+
+    def update(self, timestamp: float, value: float) -> Tuple[float, float]:
+
+        if self.value is None or timestamp - self.timestamp > self.max_gap:
+            self.value = value
+            self.velocity = 0.0
+            self.timestamp = timestamp
+
+            # the velocity is unknown at the start
+            self.p00 = self.measurement_noise
+            self.p01 = 0.0
+            self.p11 = self.measurement_noise
+
+            return self.value, self.velocity
+
+        duration = timestamp - self.timestamp
+
+        # predict, samples with the same timestamp are only used for the correction
+        if duration > 0:
+            q = self.process_noise
+
+            self.value += self.velocity * duration
+
+            self.p00 += duration * (2 * self.p01 + duration * self.p11) + q * duration ** 3 / 3
+            self.p01 += duration * self.p11 + q * duration ** 2 / 2
+            self.p11 += q * duration
+
+            self.timestamp = timestamp
+
+        # correct with the sample
+        residual = value - self.value
+        gain0 = self.p00 / (self.p00 + self.measurement_noise)
+        gain1 = self.p01 / (self.p00 + self.measurement_noise)
+
+        self.value += gain0 * residual
+        self.velocity += gain1 * residual
+
+        self.p11 -= gain1 * self.p01
+        self.p00 *= 1 - gain0
+        self.p01 *= 1 - gain0
+
+        return self.value, self.velocity
+
+
+filter_types: Dict[str, Callable[..., Filter]] = {
+    'ema': EmaFilter,
+    'kalman': KalmanFilter,
+}
+
+
+class Smoother():
+    """
+    The filters of all smoothed commands. Commands without a filter are not smoothed.
+    """
+
+    def __init__(self, filters: Dict[str, Filter]) -> None:
+        """
+        :param filters: The filter of every smoothed command, by sample name (e.g. 'rpm').
+        """
+
+        self.filters = filters
+
+        self.lock = Lock()
+
+    def update(self, name: str, timestamp: float, value: float) -> Tuple[float, float]:
+        """
+        Returns the smoothed value and velocity of the sample, None if `name` is not smoothed.
+        """
+
+        sample_filter = self.filters.get(name)
+
+        if not sample_filter: return None
+
+        with self.lock:
+            return sample_filter.update(timestamp, value)
+
+    def reset(self) -> None:
+
+        with self.lock:
+            for sample_filter in self.filters.values():
+                sample_filter.reset()
+
+
+def load_smoothing_config(config_path: str) -> Smoother:
+    """
+    Creates the filters from the `smoothing` section of a yaml file like this:
+
+        smoothing:
+          RPM:
+            filter: kalman
+            process_noise: 500000
+            measurement_noise: 400
+          SPEED:
+            filter: ema
+            alpha: 0.5
+
+    All other keys of a command are passed to the filter. Returns None if the file or the section does not exist.
+    Raises UnknownFilterException if a filter does not exist.
+    """
+
+    try:
+        with open(config_path) as config_file:
+            config = yaml.safe_load(config_file) or dict()
+    except FileNotFoundError:
+        return None
+
+    smoothing_config = config.get('smoothing')
+
+    if not smoothing_config: return None
+
+    filters = dict()
+
+    for command, filter_config in smoothing_config.items():
+        filter_config = dict(filter_config or {})
+        filter_type = filter_config.pop('filter', 'ema')
+
+        if filter_type not in filter_types:
+            raise UnknownFilterException(filter_type)
+
+        filters[command.lower()] = filter_types[filter_type](**{ key: float(value) for key, value in filter_config.items() })
+
+    return Smoother(filters)
+
+
+class UnknownFilterException(Exception):
+    """
+    Is raised when the smoothing config uses a filter that does not exist.
+    """
+
+    def __init__(self, filter_type: str) -> None:
+        super().__init__(f'The filter \'{filter_type}\' does not exist, use one of: {", ".join(filter_types)}')
@@ -0,0 +1,91 @@
+import copy
+from threading import Lock
+from typing import Any, Dict, List
+
+
+class StateStore():
+    """
+    Keeps the latest data sent on every channel, so a client that (re)connects can be sent the current state right away
+    instead of waiting for the next update of every channel.
+
+    Channels updated with update() are versioned: only the fields that changed are sent, together with the new version.
+    A delta looks like { 'version': 5, 'base': 4, 'title': '...' }, a full state like { 'version': 5, 'full': True, 'title': '...', ... }.
+    A client applies a delta only if `base` is the version it has, otherwise it asks for a full state.
+    """
+
+    def __init__(self) -> None:
+
+        self.lock = Lock()
+
+        self.data: Dict[str, Any] = dict()
+        """Latest data of every channel."""
+
+        self.versions: Dict[str, int] = dict()
+        """Version of every versioned channel, incremented on every change."""
+
+    def set(self, channel: str, data: Any) -> None:
+
+        with self.lock:
+            self.data[channel] = data
+
+    def get(self, channel: str, default: Any = None) -> Any:
+
+        with self.lock:
+            return self.data.get(channel, default)
+
+    def update(self, channel: str, data: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Merges the fields of `data` into the state of `channel`. Fields that are left out keep their value.
+        Returns the delta of the fields that changed, None if nothing changed.
+        """
+
+        with self.lock:
+            state = self.data.get(channel) or dict()
+
+            # copies, so objects the caller changes in place later (e.g. the devices of the registry) are still compared against what was sent
+            changes = { key: copy.deepcopy(value) for key, value in data.items() if key not in state or state[key] != value }
+
+            if not changes: return None
+
+            version = self.versions.get(channel, 0) + 1
+
+            self.data[channel] = { **state, **changes }
+            self.versions[channel] = version
+
+            return { 'version': version, 'base': version - 1, **changes }
+
+    def version(self, channel: str) -> int:
+        """
+        Returns the version of `channel`, 0 if it was never updated.
+        """
+
+        with self.lock:
+            return self.versions.get(channel, 0)
+
+    def full(self, channel: str) -> Dict[str, Any]:
+        """
+        Returns the full state of the versioned `channel`, None if it was never updated.
+        """
+
+        with self.lock:
+            if channel not in self.versions: return None
+
+            return { 'version': self.versions[channel], 'full': True, **self.data[channel] }
+
+    def snapshot(self, channels: List[str]) -> Dict[str, Any]:
+        """
+        Returns the latest data of `channels`, channels that never had data are left out.
+        Versioned channels are returned as full state.
+        """
+
+        snapshot = dict()
+
+        for channel in channels:
+            if channel in self.versions:
+                snapshot[channel] = self.full(channel)
+            else:
+                with self.lock:
+                    if channel in self.data: snapshot[channel] = self.data[channel]
+
+        return snapshot
+
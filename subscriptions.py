@@ -0,0 +1,111 @@
+from threading import Lock, Event
+from typing import Dict, List, Set
+
+
+class Subscriptions():
+    """
+    Keeps track of which websocket client is subscribed to which channel (e.g. 'telemetry', 'player_update', 'obd_status').
+
+    A message sent on a channel only reaches its subscribers.
+    Producers ask has_subscribers() before doing any work for a channel, so nothing is produced for a channel nobody renders.
+    """
+
+    def __init__(self, channels: List[str]) -> None:
+        """
+        :param channels: All channels clients can subscribe to.
+        """
+
+        self.channels = list(channels)
+
+        self.lock = Lock()
+
+        self.clients: Dict[str, Set[str]] = dict()
+        """Channels of every client, by socket.io session id."""
+
+        # is set while a channel has at least one subscriber
+        self.active: Dict[str, Event] = { channel: Event() for channel in self.channels }
+
+        self.counts: Dict[str, int] = { channel: 0 for channel in self.channels }
+
+    def subscribe(self, sid: str, channels: List[str]) -> List[str]:
+        """
+        Subscribes the client `sid` to `channels`. Unknown channels are ignored.
+        Returns the channels the client was not subscribed to before.
+        """
+
+        added = list()
+
+        with self.lock:
+            subscribed = self.clients.setdefault(sid, set())
+
+            for channel in channels:
+                if channel not in self.active or channel in subscribed: continue
+
+                subscribed.add(channel)
+                added.append(channel)
+
+                self.counts[channel] += 1
+                self.active[channel].set()
+
+        return added
+
+    def unsubscribe(self, sid: str, channels: List[str]) -> List[str]:
+        """
+        Unsubscribes the client `sid` from `channels`. Returns the channels it was subscribed to.
+        """
+
+        removed = list()
+
+        with self.lock:
+            subscribed = self.clients.get(sid, set())
+
+            for channel in channels:
+                if channel not in subscribed: continue
+
+                subscribed.remove(channel)
+                removed.append(channel)
+
+                self.counts[channel] -= 1
+                if not self.counts[channel]: self.active[channel].clear()
+
+        return removed
+
+    def remove(self, sid: str) -> None:
+        """
+        Forgets the client `sid`, e.g. after it disconnected.
+        """
+
+        self.unsubscribe(sid, self.channels_of(sid))
+
+        with self.lock:
+            self.clients.pop(sid, None)
+
+    def channels_of(self, sid: str) -> List[str]:
+
+        with self.lock:
+            return list(self.clients.get(sid, set()))
+
+    def subscribers(self, channel: str) -> List[str]:
+        """
+        Returns the session ids of the clients subscribed to `channel`.
+        """
+
+        with self.lock:
+            return [sid for sid, channels in self.clients.items() if channel in channels]
+
+    def has_subscribers(self, channel: str) -> bool:
+        return self.active[channel].is_set()
+
+    def wait_for_subscribers(self, channel: str, timeout: float = None) -> bool:
+        """
+        Blocks until `channel` has a subscriber or `timeout` seconds passed. Returns True/False depending on if it has one.
+        """
+        return self.active[channel].wait(timeout)
+
+    def to_dict(self) -> Dict[str, int]:
+        """
+        Returns the number of subscribers of every channel.
+        """
+
+        with self.lock:
+            return dict(self.counts)
@@ -0,0 +1,134 @@
+import time
+import logging
+from threading import Lock, Event
+from typing import Callable, Dict, Any
+
+
+class TelemetryAggregator():
+    """
+    Collects the latest value of every watched obd command and sends them together as one frame per tick.
+
+    Instead of one websocket message per command and sample, `emit` is called at most once every `interval` seconds
+    with a frame like { 'seq': 12, 'timestamp': 1700000000.123, 'values': { 'rpm': 850.0, 'speed': 0.0 } }.
+    A tick where no value was updated is skipped.
+
+    Smoothed values also have a velocity (change per second) and the timestamp of their sample,
+    in the frame as { 'velocities': { 'rpm': 120.5 }, 'sampled': { 'rpm': 1700000000.05 } }.
+    Clients can extrapolate them between frames: value + velocity * (now - sampled).
+    """
+
+    def __init__(self, emit: Callable[[Dict[str, Any]], None], interval: float = 0.2, logger: logging.Logger = None) -> None:
+        """
+        :param emit: Is called with every frame, e.g. to send it per websocket.
+        :param interval: Seconds between two frames.
+        """
+
+        # if logger is set, use it
+        # if logger is not set a null_logger is created that wont log anything
+        if logger:
+            self.logger = logger
+        else:
+            # create a logger
+            self.logger = logging.getLogger('null_logger')
+
+            # create a NullHandler and add it to the logger
+            null_handler = logging.NullHandler()
+            self.logger.addHandler(null_handler)
+
+            # set the logger level to NOTSET to capture all messages
+            self.logger.setLevel(logging.NOTSET)
+
+        self.emit = emit
+        self.interval = interval
+
+        self.lock = Lock()
+
+        self.values: Dict[str, Any] = dict()
+        """Latest value of every command, by name."""
+
+        self.velocities: Dict[str, float] = dict()
+        """Velocity of the values that have one, by name."""
+
+        self.sampled: Dict[str, float] = dict()
+        """Timestamp of the sample of the values that have a velocity, by name."""
+
+        self.dirty = False
+        """Is True if a value was updated since the last frame."""
+
+        self.seq = 0
+        """Sequence number of the last frame sent."""
+
+    def update(self, name: str, value: Any, velocity: float = None, timestamp: float = None) -> None:
+        """
+        Sets the latest value of `name`. It is sent with the next frame.
+
+        :param velocity: Change of the value per second, if it is known.
+        :param timestamp: Timestamp of the sample, needed with `velocity`.
+        """
+
+        with self.lock:
+            self.values[name] = value
+            self.dirty = True
+
+            if velocity is not None:
+                self.velocities[name] = velocity
+                self.sampled[name] = timestamp
+
+    def clear(self) -> None:
+        """
+        Forgets all values, e.g. when the connection to the car was lost.
+        The next tick sends a frame without values, which also replaces the frame clients get in their snapshot.
+        """
+
+        with self.lock:
+            self.values = dict()
+            self.velocities = dict()
+            self.sampled = dict()
+            self.dirty = True
+
+    def tick(self) -> None:
+        """
+        Sends a frame with the latest values if any value was updated since the last frame.
+        """
+
+        with self.lock:
+            if not self.dirty: return
+
+            self.seq += 1
+            self.dirty = False
+
+            frame = {
+                'seq': self.seq,
+                'timestamp': time.time(),
+                'values': dict(self.values),
+            }
+
+            if self.velocities:
+                frame['velocities'] = dict(self.velocities)
+                frame['sampled'] = dict(self.sampled)
+
+        self.emit(frame)
+
+    def run(self, stop_event: Event) -> None:
+        """
+        Calls tick() every `interval` seconds until `stop_event` is set.
+        Sleeps until the next tick is due, so the rate does not drift by the time sending takes.
+        """
+
+        self.logger.info('Starting to send telemetry frames every %s seconds.', self.interval)
+
+        next_tick = time.monotonic()
+
+        while not stop_event.is_set():
+            next_tick += self.interval
+
+            try:
+                self.tick()
+            except Exception:
+                self.logger.error('Error while sending telemetry frame.', exc_info=1)
+
+            # if sending took longer than the interval, skip the missed ticks instead of catching up
+            now = time.monotonic()
+            if next_tick < now: next_tick = now
+
+            stop_event.wait(next_tick - now)
@@ -0,0 +1,132 @@
+from array import array
+from bisect import bisect_left, bisect_right
+from threading import Lock
+from typing import Dict, List, Tuple
+
+
+class RingBuffer():
+    """
+    Keeps the last `capacity` samples (timestamp and value) of one command in two preallocated typed arrays.
+    Memory does not grow after creation, the oldest sample is overwritten when the buffer is full.
+    """
+
+    def __init__(self, capacity: int) -> None:
+
+        self.capacity = capacity
+
+        self.timestamps = array('d', bytes(8 * capacity))
+        self.values = array('d', bytes(8 * capacity))
+
+        self.next_index = 0
+        """Index the next sample is written to."""
+
+        self.count = 0
+
+    def append(self, timestamp: float, value: float) -> None:
+
+        self.timestamps[self.next_index] = timestamp
+        self.values[self.next_index] = value
+
+        self.next_index = (self.next_index + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def ordered(self) -> Tuple[array, array]:
+        """
+        Returns copies of the timestamps and values, from the oldest to the newest sample.
+        """
+
+        if self.count < self.capacity:
+            return self.timestamps[:self.count], self.values[:self.count]
+
+        # the oldest sample is at next_index when the buffer is full
+        return (
+            self.timestamps[self.next_index:] + self.timestamps[:self.next_index],
+            self.values[self.next_index:] + self.values[:self.next_index],
+        )
+
+    def window(self, start: float, end: float) -> Tuple[array, array]:
+        """
+        Returns the timestamps and values of all samples with `start` <= timestamp <= `end`.
+        """
+
+        timestamps, values = self.ordered()
+
+        # timestamps only grow, so the window can be found by binary search
+        first = bisect_left(timestamps, start)
+        last = bisect_right(timestamps, end)
+
+        return timestamps[first:last], values[first:last]
+
+
+def downsample(timestamps: array, values: array, points: int) -> Dict[str, List[float]]:
+    """
+    Reduces the samples to at most `points` buckets of equal sample count.
+    Every bucket is described by its first timestamp and the min, max and mean of its values.
+    """
+
+    count = len(values)
+    bucket_count = min(points, count)
+
+    downsampled = { 'timestamp': [], 'min': [], 'max': [], 'mean': [] }
+
+    for bucket in range(bucket_count):
+        first = bucket * count // bucket_count
+        last = (bucket + 1) * count // bucket_count
+
+        # min, max and sum run over the array slices in C
+        bucket_values = values[first:last]
+
+        downsampled['timestamp'].append(timestamps[first])
+        downsampled['min'].append(min(bucket_values))
+        downsampled['max'].append(max(bucket_values))
+        downsampled['mean'].append(sum(bucket_values) / len(bucket_values))
+
+    return downsampled
+
+
+class TelemetryHistory():
+    """
+    Keeps a ring buffer of the recent samples of every command, so clients can draw the recent history of a value.
+    """
+
+    def __init__(self, capacity: int = 3000) -> None:
+        """
+        :param capacity: How many samples are kept per command.
+        """
+
+        self.capacity = capacity
+
+        self.buffers: Dict[str, RingBuffer] = dict()
+
+        self.lock = Lock()
+
+    def append(self, name: str, timestamp: float, value: float) -> None:
+
+        with self.lock:
+            buffer = self.buffers.get(name)
+
+            if not buffer:
+                buffer = self.buffers[name] = RingBuffer(self.capacity)
+
+            buffer.append(timestamp, value)
+
+    def names(self) -> List[str]:
+
+        with self.lock:
+            return list(self.buffers)
+
+    def query(self, names: List[str], start: float, end: float, points: int) -> Dict[str, Dict[str, List[float]]]:
+        """
+        Returns the samples of the commands in `names` between `start` and `end`, downsampled to at most `points` buckets per command.
+        Unknown names are left out.
+        """
+
+        windows = dict()
+
+        with self.lock:
+            for name in names:
+                if name in self.buffers:
+                    windows[name] = self.buffers[name].window(start, end)
+
+        # downsampling happens outside of the lock, so the obd callbacks are not blocked by it
+        return { name: downsample(timestamps, values, points) for name, (timestamps, values) in windows.items() }
@@ -0,0 +1,497 @@
+import math
+import time
+import random
+import logging
+from abc import ABC, abstractmethod
+from threading import Event
+from typing import Callable, Dict, List
+
+import obd
+
+from obd_scheduler import ObdScheduler, WatchedCommand
+from obd_reconnect import AdapterCache, Backoff
+from trip_recorder import TripReader
+
+
+class TelemetrySource(ABC):
+    """
+    Produces samples (name, timestamp, value) and passes them to `on_sample`.
+
+    Implementations are the real obd connection (ObdSource), a generator of fake samples (SyntheticSource)
+    and the replay of a recorded trip (ReplaySource). They all drive the same callbacks, so the rest of the server
+    does not know where the samples come from.
+    """
+
+    def __init__(self, on_sample: Callable[[str, float, float], None], on_status: Callable[[str], None] = None, on_ready: Callable[[str], None] = None, logger: logging.Logger = None) -> None:
+        """
+        :param on_sample: Is called with the name (e.g. 'rpm'), timestamp and value of every sample.
+        :param on_status: Is called with a message describing the state of the source, e.g. 'Car connected'.
+        :param on_ready: Is called once with the status message, when the source finished its first initialization.
+        """
+
+        # if logger is set, use it
+        # if logger is not set a null_logger is created that wont log anything
+        if logger:
+            self.logger = logger
+        else:
+            # create a logger
+            self.logger = logging.getLogger('null_logger')
+
+            # create a NullHandler and add it to the logger
+            null_handler = logging.NullHandler()
+            self.logger.addHandler(null_handler)
+
+            # set the logger level to NOTSET to capture all messages
+            self.logger.setLevel(logging.NOTSET)
+
+        self.on_sample = on_sample
+        self.on_status = on_status or (lambda message: None)
+        self.on_ready = on_ready or (lambda message: None)
+
+    @abstractmethod
+    def run(self, stop_event: Event) -> None:
+        """
+        Produces samples until `stop_event` is set. Is run in its own thread.
+        """
+
+    def close(self) -> None:
+        """
+        Releases everything the source holds (connections, files). Should be called before exiting program.
+        """
+        pass
+
+
+class ObdSource(TelemetrySource):
+    """
+    Reads the watched commands from the car over an obd adapter and reconnects when the connection is lost.
+
+    The port and protocol of the last working connection are cached (also across restarts) and tried first,
+    the serial ports are only scanned when the cached port is gone.
+    While the adapter is connected but the ignition is off, the connection to the adapter is kept open and the car is probed over it
+    every `ignition_off_interval` seconds. Such a probe only reads the battery voltage from the adapter, the car itself is only asked
+    when the voltage shows a running engine or on every `full_probe_every`-th probe.
+    Failed attempts to reach the adapter are retried with exponential backoff.
+    """
+
+    def __init__(self, on_sample: Callable[[str, float, float], None], watched_commands: List[WatchedCommand], adapter_serial_name: str = 'serial', cache_path: str = None, on_connect: Callable[[], None] = None, on_disconnect: Callable[[], None] = None, on_rates: Callable[[Dict[str, float]], None] = None, on_status: Callable[[str], None] = None, on_ready: Callable[[str], None] = None, logger: logging.Logger = None) -> None:
+        """
+        :param adapter_serial_name: A part of the name of the serial port the adapter is connected to.
+        :param cache_path: Where the port and protocol of the last working connection are saved. Not saved if None.
+        :param on_connect: Is called every time a connection to the car was made.
+        :param on_disconnect: Is called every time a connection to the car is closed.
+        :param on_rates: Is called regularly with the effective queries per second of every watched command while the car is connected.
+        """
+
+        super().__init__(on_sample, on_status=on_status, on_ready=on_ready, logger=logger)
+
+        self.watched_commands = watched_commands
+        self.adapter_serial_name = adapter_serial_name
+
+        self.on_connect = on_connect or (lambda: None)
+        self.on_disconnect = on_disconnect or (lambda: None)
+        self.on_rates = on_rates
+
+        self.connection: obd.OBD = None
+
+        # queries the watched commands over `connection`, each at its configured rate
+        self.scheduler: ObdScheduler = None
+
+        # set by the scheduler when the car stopped answering, python-OBD still reports CAR_CONNECTED then
+        self.car_silent = Event()
+
+        # the car stopped answering and the scheduler was stopped, the open connection is used to probe the car
+        self.car_asleep = False
+
+        self.adapter_cache = AdapterCache(cache_path, logger=self.logger) if cache_path else None
+
+        self.backoff = Backoff()
+
+        # how often the connection is checked while the car is connected
+        self.check_interval = 5
+
+        # how often the car is probed while the adapter is connected, but the ignition is off
+        self.ignition_off_interval = 10
+
+        # with the engine running the alternator charges the battery above this voltage
+        self.charging_voltage = 13.2
+
+        # every this many probes the car is asked, even if the voltage did not change, e.g. ignition on without starting the engine
+        self.full_probe_every = 6
+
+        self.probe_count = 0
+
+    def handle_response(self, response: obd.OBDResponse) -> None:
+        """
+        Callback for watched obd commands. Passes the value on under the lowercase command name (e.g. 'rpm').
+
+        Null responses are skipped. Samples are numbers: lists (e.g. the trouble codes of GET_DTC) are passed on as their length,
+        other values without a number (e.g. strings) are skipped.
+        """
+
+        # no answer is not a value of 0, e.g. while the ignition is turned off
+        if response.is_null():
+            return
+        elif hasattr(response.value, 'magnitude'):
+            value = response.value.magnitude
+        elif isinstance(response.value, (list, tuple)):
+            value = len(response.value)
+        elif isinstance(response.value, (bool, int, float)):
+            value = float(response.value)
+        else:
+            self.logger.debug('Skipping the non-numeric value of \'%s\'.', response.command.name)
+            return
+
+        self.on_sample(response.command.name.lower(), response.time, value)
+
+    def find_adapter_port(self) -> str:
+        """
+        Returns the cached port if it still exists, otherwise scans the serial ports for the adapter. Returns None if none was found.
+        """
+
+        if self.adapter_cache and self.adapter_cache.port_exists():
+            return self.adapter_cache.port
+
+        ports = obd.scan_serial()
+
+        adapter_port = None
+
+        # my current adapter has 'serial' in the name so I use that to select it
+        for port in ports:
+            if self.adapter_serial_name in port:
+                self.logger.info('An obd adapter was found: %s', port)
+                adapter_port = port
+
+        if not adapter_port:
+            self.logger.error('No obd adapter was found')
+
+        return adapter_port
+
+    def connect(self) -> None:
+        """
+        Initializes a new obd connection and starts the scheduler querying the watched commands.
+        On the cached port the cached protocol is used, which skips the protocol detection.
+        """
+
+        adapter_port = self.find_adapter_port()
+
+        protocol = None
+
+        if self.adapter_cache and adapter_port and adapter_port == self.adapter_cache.port:
+            protocol = self.adapter_cache.protocol
+
+        self.logger.info('Trying to initialize connection: \'%s\' (protocol \'%s\')', adapter_port, protocol)
+
+        self.car_asleep = False
+        self.car_silent.clear()
+
+        self.connection = obd.OBD(adapter_port, protocol=protocol)
+
+        # with a given protocol python-OBD reports CAR_CONNECTED unless the adapter answers 'UNABLE TO CONNECT',
+        # even when the ignition is off and the car answers 'NO DATA', so the car is asked for real
+        # the cached protocol might also be wrong for a different car, try again with detection
+        if protocol and (self.connection.status() == obd.OBDStatus.OBD_CONNECTED or not self.car_answers()):
+            self.logger.info('Cached protocol \'%s\' did not work, detecting protocol.', protocol)
+
+            self.connection.close()
+            self.connection = obd.OBD(adapter_port)
+
+        self.start_scheduler()
+
+    def start_scheduler(self) -> None:
+        """
+        Starts the scheduler, if the car is connected. Saves the port and protocol of the connection for the next time.
+        """
+
+        # dont start watchers, when no connection to car was made
+        if self.connection.status() != obd.OBDStatus.CAR_CONNECTED:
+            self.logger.warning('Car is not connected on connection: \'%s\'', self.connection.port_name())
+            return
+
+        if self.adapter_cache:
+            self.adapter_cache.save(self.connection.port_name(), self.connection.protocol_id())
+
+        self.on_connect()
+
+        self.scheduler = ObdScheduler(self.connection, self.watched_commands, callback=self.handle_response, on_rates=self.on_rates, on_silent=self.car_silent.set, logger=self.logger)
+        self.scheduler.start()
+
+    def read_voltage(self) -> float:
+        """
+        Returns the battery voltage measured by the adapter, None if it can not be read. Does not send anything to the car.
+        """
+
+        try:
+            response = self.connection.query(obd.commands.ELM_VOLTAGE, force=True)
+        except Exception:
+            return None
+
+        return None if response.is_null() else response.value.magnitude
+
+    def car_answers(self) -> bool:
+        """
+        Asks the car for its supported PIDs. Returns True if it answered with data.
+        """
+
+        try:
+            response = self.connection.query(obd.commands.PIDS_A, force=True)
+        except Exception:
+            self.logger.warning('Asking the car failed.', exc_info=1)
+            return False
+
+        return not response.is_null()
+
+    def probe_car(self) -> bool:
+        """
+        Asks the car for a response over the open connection to the adapter, without closing it.
+        Returns True if the car answered, e.g. because the ignition was turned on.
+
+        To keep the car asleep, the car is only asked when the battery voltage shows a running engine or on every `full_probe_every`-th probe.
+        """
+
+        self.probe_count += 1
+
+        voltage = self.read_voltage()
+
+        if voltage is not None and voltage < self.charging_voltage and self.probe_count % self.full_probe_every:
+            self.logger.debug('Battery at %.1f V, not asking the car.', voltage)
+            return False
+
+        protocol = self.connection.protocol_id() or (self.adapter_cache.protocol if self.adapter_cache else None)
+
+        try:
+            # without the ignition there is no protocol, the adapter has to be set to one before it can ask the car
+            if not self.connection.interface.set_protocol(protocol or None):
+                return False
+        except Exception:
+            self.logger.warning('Probing the car failed.', exc_info=1)
+            return False
+
+        # set_protocol() also succeeds when the car answers 'NO DATA' or 'CAN ERROR', only data means the ignition is on
+        return self.car_answers()
+
+    def status(self) -> obd.OBDStatus:
+        """
+        The status of the connection. OBD_CONNECTED (ignition off) while the car is asleep, even though python-OBD still reports CAR_CONNECTED.
+        """
+
+        status = self.connection.status()
+
+        if self.car_asleep and status == obd.OBDStatus.CAR_CONNECTED:
+            return obd.OBDStatus.OBD_CONNECTED
+
+        return status
+
+    def stop_scheduler(self) -> None:
+        """
+        Stops the scheduler, which ends the trip with `on_disconnect`.
+        """
+
+        if self.scheduler:
+            self.scheduler.stop()
+            self.scheduler = None
+
+            self.on_disconnect()
+
+    def close(self) -> None:
+        """
+        Stops the scheduler and closes the obd connection.
+        """
+
+        self.stop_scheduler()
+
+        if self.connection:
+            self.connection.close()
+            self.connection = None
+
+    def run(self, stop_event: Event) -> None:
+        """
+        First it calls connect(). After that it creates an endless loop that keeps the connection to the car.
+        This also reports the current obd status with `on_status`, the first time right after connecting.
+
+        - car connected: the connection is checked every `check_interval` seconds,
+          when the car stopped answering (ignition turned off after a drive) the scheduler is stopped and the car is probed like below
+        - adapter connected, ignition off: the car is probed every `ignition_off_interval` seconds over the open connection (see probe_car()),
+          it is only reopened when the car answers
+        - adapter missing: a new connection is made, on the cached port if it still exists, otherwise after a scan
+
+        Attempts that do not reach the car are repeated with exponential backoff.
+        """
+
+        self.on_status('Connecting to the obd adapter')
+
+        self.connect()
+        self.report_status()
+
+        self.on_ready(self.status_message())
+
+        while True:
+
+            status = self.status()
+
+            if status == obd.OBDStatus.CAR_CONNECTED:
+                self.backoff.reset()
+                delay = self.check_interval
+            elif status == obd.OBDStatus.OBD_CONNECTED:
+                # the adapter is there, only the ignition is off, a slow low-power probe is enough
+                delay = self.ignition_off_interval
+            else:
+                delay = self.backoff.next()
+
+            if stop_event.wait(delay): break
+
+            # the car went to sleep, the adapter stays connected and is used for the probes
+            if self.car_silent.is_set() and self.scheduler:
+                self.logger.info('The car stopped answering, ignition off.')
+
+                self.car_asleep = True
+                self.stop_scheduler()
+                self.report_status()
+                continue
+
+            # the status did not change on its own
+            if status == obd.OBDStatus.CAR_CONNECTED and self.status() == status:
+                self.report_status()
+                continue
+
+            if self.status() in (obd.OBDStatus.ELM_CONNECTED, obd.OBDStatus.OBD_CONNECTED):
+
+                if not self.probe_car():
+                    continue
+
+                self.logger.info('The car answered, reconnecting on \'%s\'', self.connection.port_name())
+
+            # close connection, because a new one will be established
+            self.close()
+            self.connect()
+            self.report_status()
+
+    def status_message(self) -> str:
+
+        return {
+            obd.OBDStatus.NOT_CONNECTED: 'Not connected to the obd adapter',
+            obd.OBDStatus.ELM_CONNECTED: 'Connected to adapter, but no car was detected',
+            obd.OBDStatus.OBD_CONNECTED: 'Connected to car, ignition off',
+            obd.OBDStatus.CAR_CONNECTED: 'Car connected',
+        }.get(self.status(), str(self.status()))
+
+    def report_status(self) -> None:
+        """
+        Reports the status of the connection with `on_status` and logs it.
+        """
+
+        self.on_status(self.status_message())
+
+        if self.status() == obd.OBDStatus.CAR_CONNECTED:
+
+            self.logger.info('Connected to car')
+
+        elif self.status() == obd.OBDStatus.NOT_CONNECTED:
+
+            self.logger.error('No connection to obd adapter')
+
+        elif self.status() == obd.OBDStatus.ELM_CONNECTED:
+
+            self.logger.error('Connected to adapter \'%s\', but no car was detected', self.connection.port_name())
+
+        elif self.status() == obd.OBDStatus.OBD_CONNECTED:
+
+            self.logger.info('Connected to car (through \'%s\'), ignition off', self.connection.port_name())
+
+
+class SyntheticSource(TelemetrySource):
+    """
+    Generates fake samples for `pid_count` commands at `sample_rate` samples per second each.
+    The first two commands are 'rpm' and 'speed' with plausible values, the others are named 'synthetic_<n>'.
+    """
+
+    def __init__(self, on_sample: Callable[[str, float, float], None], pid_count: int = 2, sample_rate: float = 10, on_status: Callable[[str], None] = None, on_ready: Callable[[str], None] = None, logger: logging.Logger = None) -> None:
+
+        super().__init__(on_sample, on_status=on_status, on_ready=on_ready, logger=logger)
+
+        self.names = ['rpm', 'speed'][:pid_count] + [f'synthetic_{index}' for index in range(2, pid_count)]
+        self.sample_rate = sample_rate
+
+    def value(self, index: int, elapsed: float) -> float:
+        """
+        A slow sine wave with a bit of noise, every command with its own period.
+        """
+
+        wave = (math.sin(elapsed / (5 + index)) + 1) / 2
+
+        if index == 0: return round(800 + wave * 3000 + random.uniform(-50, 50))
+        if index == 1: return round(wave * 120)
+
+        return wave * 100 + random.uniform(-1, 1)
+
+    def run(self, stop_event: Event) -> None:
+
+        self.logger.info('Generating synthetic samples for %d commands at %s Hz.', len(self.names), self.sample_rate)
+        self.on_status('Synthetic data')
+        self.on_ready('Synthetic data')
+
+        start = time.monotonic()
+        next_sample = start
+
+        while not stop_event.is_set():
+            now = time.time()
+            elapsed = time.monotonic() - start
+
+            for index, name in enumerate(self.names):
+                self.on_sample(name, now, self.value(index, elapsed))
+
+            next_sample += 1 / self.sample_rate
+            stop_event.wait(max(next_sample - time.monotonic(), 0))
+
+
+class ReplaySource(TelemetrySource):
+    """
+    Plays back a trip recorded by TripRecorder, `speed` times as fast as it was recorded.
+    The timestamps are shifted, so the samples look like they are happening now.
+    """
+
+    def __init__(self, on_sample: Callable[[str, float, float], None], segment_path: str, speed: float = 1.0, loop: bool = False, on_status: Callable[[str], None] = None, on_ready: Callable[[str], None] = None, logger: logging.Logger = None) -> None:
+        """
+        :param segment_path: The segment file of the trip.
+        :param loop: Start over at the end of the trip instead of stopping.
+        """
+
+        super().__init__(on_sample, on_status=on_status, on_ready=on_ready, logger=logger)
+
+        self.segment_path = segment_path
+        self.speed = speed
+        self.loop = loop
+
+    def run(self, stop_event: Event) -> None:
+
+        self.logger.info('Replaying trip \'%s\' at %sx speed.', self.segment_path, self.speed)
+        self.on_status('Replaying recorded trip')
+        self.on_ready('Replaying recorded trip')
+
+        while not stop_event.is_set():
+            with TripReader(self.segment_path) as reader:
+                replay_start = time.monotonic()
+                trip_start = None
+
+                for name, timestamp, value in reader.range():
+                    if trip_start is None: trip_start = timestamp
+
+                    # wait until the sample is due
+                    due = replay_start + (timestamp - trip_start) / self.speed
+
+                    if stop_event.wait(max(due - time.monotonic(), 0)): return
+
+                    self.on_sample(name, time.time(), value)
+
+            # an empty trip would be started over and over
+            if not self.loop or trip_start is None: break
+
+        self.logger.info('Finished replaying trip \'%s\'', self.segment_path)
+
+
+class MissingReplayPathException(Exception):
+    """
+    Is raised when the replay source is selected without a trip to replay.
+    """
+
+    def __init__(self) -> None:
+        super().__init__('TELEMETRY_SOURCE is \'replay\', but REPLAY_PATH is not set. Set it to the recorded trip to replay.')
@@ -0,0 +1,155 @@
+"""
+Stand-in for a bluez `MediaPlayer1` object, served on a private D-Bus bus under the name `org.bluez`.
+
+It answers `GetAll`/`Get` of org.freedesktop.DBus.Properties with its properties and sends `PropertiesChanged`
+when they are changed with set_properties(), like bluez does when the phone changes the track or starts playing.
+
+usage: python tests/stub_media_player.py --bus <address of the bus>
+"""
+
+import queue
+import argparse
+from threading import Thread, Event
+from typing import Any, Dict, Tuple
+
+from jeepney import DBusAddress, MessageType, new_error, new_method_return, new_signal, message_bus
+from jeepney.io.blocking import open_dbus_connection
+
+
+player_path = '/org/bluez/hci0/dev_AA_BB_CC_DD_EE_FF/player0'
+media_player_interface = 'org.bluez.MediaPlayer1'
+properties_interface = 'org.freedesktop.DBus.Properties'
+
+
+def track(title: str, artist: str, duration: int) -> Tuple[str, Dict[str, Any]]:
+    """
+    Returns a `Track` property as D-Bus variant. `duration` is in milliseconds, like bluez reports it.
+    """
+
+    return ('a{sv}', {
+        'Title': ('s', title),
+        'Artist': ('s', artist),
+        'Duration': ('u', duration),
+    })
+
+
+class StubMediaPlayer():
+    """
+    Serves one `MediaPlayer1` object at `player_path` on the bus `bus` from a background thread.
+    """
+
+    def __init__(self, bus: str, path: str = player_path, stalled: bool = False) -> None:
+        """
+        :param bus: The address of the bus, e.g. of a private `dbus-daemon --session`.
+        :param stalled: Never reply to method calls, like a bluez that hangs.
+        """
+
+        self.bus = bus
+        self.path = path
+        self.stalled = stalled
+
+        self.properties: Dict[str, Tuple[str, Any]] = {
+            'Name': ('s', 'Stub'),
+            'Status': ('s', 'paused'),
+            'Position': ('u', 0),
+            'Track': track('First Song', 'Stub Band', 240000),
+        }
+
+        # signals are sent by the serving thread, the connection is not shared between threads
+        self.signals: queue.Queue = queue.Queue()
+
+        self.connection = None
+
+        self.stop_event = Event()
+        self.thread: Thread = None
+
+    def start(self) -> None:
+        """
+        Connects to the bus and takes the name `org.bluez`. The object is served as soon as this returns.
+        """
+
+        self.connection = open_dbus_connection(bus=self.bus)
+        self.connection.send_and_get_reply(message_bus.RequestName('org.bluez'), timeout=2)
+
+        self.thread = Thread(target=self._serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self) -> None:
+
+        self.stop_event.set()
+
+        if self.thread:
+            self.thread.join(timeout=2)
+
+        if self.connection:
+            self.connection.close()
+            self.connection = None
+
+    def set_properties(self, **properties: Tuple[str, Any]) -> None:
+        """
+        Changes properties (as variants, e.g. Status=('s', 'playing')) and sends `PropertiesChanged` for them.
+        """
+
+        self.properties.update(properties)
+        self.signals.put(properties)
+
+    def _serve(self) -> None:
+
+        while not self.stop_event.is_set():
+            while not self.signals.empty():
+                emitter = DBusAddress(self.path, interface=properties_interface)
+                self.connection.send(new_signal(emitter, 'PropertiesChanged', 'sa{sv}as', (media_player_interface, self.signals.get(), [])))
+
+            try:
+                message = self.connection.receive(timeout=0.05)
+            except TimeoutError:
+                continue
+            except OSError:
+                return
+
+            if message.header.message_type != MessageType.method_call or self.stalled: continue
+
+            self.connection.send(self._reply(message))
+
+    def _reply(self, message):
+
+        path = message.header.fields.get(1)
+        interface = message.header.fields.get(2)
+        member = message.header.fields.get(3)
+
+        if path != self.path or interface != properties_interface:
+            return new_error(message, 'org.freedesktop.DBus.Error.UnknownObject', 's', (f'No object at {path}',))
+
+        if member == 'GetAll':
+            return new_method_return(message, 'a{sv}', (self.properties,))
+
+        if member == 'Get' and message.body[1] in self.properties:
+            return new_method_return(message, 'v', (self.properties[message.body[1]],))
+
+        return new_error(message, 'org.freedesktop.DBus.Error.UnknownMethod', 's', (f'{member} is not supported',))
+
+
+def main() -> None:
+
+    parser = argparse.ArgumentParser(description='Serves a stub bluez MediaPlayer1 object on a D-Bus bus.')
+    parser.add_argument('--bus', default='SESSION', help='address of the bus, SESSION or SYSTEM')
+    args = parser.parse_args()
+
+    player = StubMediaPlayer(args.bus)
+    player.start()
+
+    print(f'Serving {player_path} on {args.bus}, press enter to toggle play/pause, ctrl+c to stop.')
+
+    try:
+        while True:
+            input()
+
+            status = 'paused' if player.properties['Status'][1] == 'playing' else 'playing'
+            player.set_properties(Status=('s', status))
+    except (KeyboardInterrupt, EOFError):
+        player.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+"""
+Runs MediaPlayerMonitor and Player.watch() against the stub MediaPlayer1 service on a private `dbus-daemon --session`.
+"""
+
+import os
+import sys
+import time
+import shutil
+import logging
+import unittest
+import subprocess
+from threading import Event
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from media_player_monitor import MediaPlayerMonitor, DBusPlayerNotFoundException, dbus_available
+
+if dbus_available():
+    from stub_media_player import StubMediaPlayer, player_path, track
+
+
+def wait_for(condition, timeout: float = 2.0) -> bool:
+
+    end = time.monotonic() + timeout
+
+    while time.monotonic() < end:
+        if condition(): return True
+        time.sleep(0.01)
+
+    return condition()
+
+
+@unittest.skipUnless(dbus_available() and shutil.which('dbus-daemon'), 'needs jeepney and dbus-daemon')
+class MediaPlayerMonitorTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+
+        self.daemon = subprocess.Popen(['dbus-daemon', '--session', '--nofork', '--print-address'], stdout=subprocess.PIPE, universal_newlines=True)
+        self.bus = self.daemon.stdout.readline().strip()
+
+        self.player = StubMediaPlayer(self.bus)
+        self.player.start()
+
+        self.changes = list()
+        self.changed = Event()
+
+        self.monitor: MediaPlayerMonitor = None
+
+    def tearDown(self) -> None:
+
+        if self.monitor: self.monitor.stop()
+
+        self.player.stop()
+
+        self.daemon.terminate()
+        self.daemon.wait()
+        self.daemon.stdout.close()
+
+    def on_change(self, properties) -> None:
+        self.changes.append(properties)
+        self.changed.set()
+
+    def test_reports_current_properties_on_start(self) -> None:
+
+        self.monitor = MediaPlayerMonitor(player_path, self.on_change, bus=self.bus)
+        self.monitor.start()
+
+        self.assertEqual(self.changes[0]['Status'], 'paused')
+        self.assertEqual(self.changes[0]['Track'], { 'Title': 'First Song', 'Artist': 'Stub Band', 'Duration': 240000 })
+
+    def test_reports_changes(self) -> None:
+
+        self.monitor = MediaPlayerMonitor(player_path, self.on_change, bus=self.bus)
+        self.monitor.start()
+
+        self.player.set_properties(Status=('s', 'playing'), Track=track('Second Song', 'Stub Band', 180000))
+
+        self.assertTrue(wait_for(lambda: len(self.changes) == 2))
+        self.assertEqual(self.changes[1]['Status'], 'playing')
+        self.assertEqual(self.changes[1]['Track']['Title'], 'Second Song')
+
+    def test_unknown_player(self) -> None:
+
+        self.monitor = MediaPlayerMonitor('/org/bluez/hci0/dev_00_00_00_00_00_00/player0', self.on_change, bus=self.bus)
+
+        with self.assertRaises(DBusPlayerNotFoundException):
+            self.monitor.start()
+
+        self.assertIsNone(self.monitor.connection)
+
+    def test_times_out_when_bluez_stalls(self) -> None:
+
+        self.player.stalled = True
+
+        self.monitor = MediaPlayerMonitor(player_path, self.on_change, bus=self.bus, timeout=0.5)
+
+        start = time.monotonic()
+
+        with self.assertRaises(TimeoutError):
+            self.monitor.start()
+
+        self.assertLess(time.monotonic() - start, 2)
+        self.assertIsNone(self.monitor.connection)
+
+    def test_player_follows_changes(self) -> None:
+
+        from player import Player
+
+        bluetoothctl_commands = lambda commands: f'Player {player_path} [default]'
+
+        player = Player(bluetoothctl_commands, player_path, dbus_bus=self.bus, logger=logging.getLogger('test'))
+
+        self.assertTrue(player.watch(self.changed.set))
+        self.monitor = player.monitor
+
+        self.assertEqual(player.song, { 'title': 'First Song', 'interpret': 'Stub Band', 'length': 240 })
+        self.assertFalse(player.isPlaying)
+
+        self.changed.clear()
+        self.player.set_properties(Status=('s', 'playing'))
+
+        self.assertTrue(self.changed.wait(2))
+        self.assertTrue(player.isPlaying)
+
+    def test_player_is_polled_when_the_bus_is_lost(self) -> None:
+
+        from player import Player
+
+        bluetoothctl_commands = lambda commands: f'Player {player_path} [default]'
+
+        player = Player(bluetoothctl_commands, player_path, dbus_bus=self.bus, logger=logging.getLogger('test'))
+
+        self.assertTrue(player.watch(self.changed.set))
+
+        self.changed.clear()
+
+        self.daemon.terminate()
+        self.daemon.wait()
+
+        # on_change wakes up the player loop, which polls the player from then on
+        self.assertTrue(self.changed.wait(3))
+        self.assertIsNone(player.monitor)
+
+
+if __name__ == '__main__':
+    unittest.main()
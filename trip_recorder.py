@@ -0,0 +1,277 @@
+import os
+import sys
+import csv
+import mmap
+import json
+import time
+import struct
+import logging
+from threading import Thread, Lock, Event
+from typing import Dict, Iterator, List, Tuple
+
+
+record_struct = struct.Struct('<Hdd')
+"""Layout of one record in a segment file: command id (uint16), timestamp (float64), value (float64)."""
+
+segment_extension = '.seg'
+names_extension = '.names.json'
+
+
+class TripRecorder():
+    """
+    Writes every sample of a trip to an append-only segment file.
+
+    Samples are collected in memory and written as one batch of fixed-width records every `flush_interval` seconds,
+    followed by an fsync. When the power is lost, at most the last batch is lost.
+    The names of the commands are stored as ids in the records, the mapping is kept in a small json file next to the segment.
+
+    record() only appends to the batch in memory. The batch is swapped out under the lock and written by the flush thread,
+    so the samples never wait for the disk.
+    """
+
+    def __init__(self, directory: str, flush_interval: float = 2.0, logger: logging.Logger = None) -> None:
+        """
+        :param directory: Where the segment files are written to. Is created if it does not exist.
+        :param flush_interval: Seconds between two batches written to disk.
+        """
+
+        # if logger is set, use it
+        # if logger is not set a null_logger is created that wont log anything
+        if logger:
+            self.logger = logger
+        else:
+            # create a logger
+            self.logger = logging.getLogger('null_logger')
+
+            # create a NullHandler and add it to the logger
+            null_handler = logging.NullHandler()
+            self.logger.addHandler(null_handler)
+
+            # set the logger level to NOTSET to capture all messages
+            self.logger.setLevel(logging.NOTSET)
+
+        self.directory = directory
+        self.flush_interval = flush_interval
+
+        self.lock = Lock()
+
+        self.segment_path: str = None
+        self.segment_fd: int = None
+
+        self.name_ids: Dict[str, int] = dict()
+        self.batch = bytearray()
+
+        # set when a new name was added, the names file is written with the next batch
+        self.names_changed = False
+
+        self.stop_event = Event()
+        self.thread: Thread = None
+
+    def start_trip(self) -> None:
+        """
+        Opens a new segment file and starts writing batches to it. A trip that is still running is ended first.
+        """
+
+        self.end_trip()
+
+        os.makedirs(self.directory, exist_ok=True)
+
+        trip_name = 'trip-' + time.strftime('%Y%m%d-%H%M%S')
+
+        with self.lock:
+            self.segment_path = os.path.join(self.directory, trip_name + segment_extension)
+            self.segment_fd = os.open(self.segment_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+            self.name_ids = dict()
+            self.batch = bytearray()
+            self.names_changed = False
+
+        self.logger.info('Recording trip to \'%s\'', self.segment_path)
+
+        self.stop_event.clear()
+
+        self.thread = Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def end_trip(self) -> None:
+        """
+        Writes the last batch and closes the segment file.
+        """
+
+        if not self.thread: return
+
+        self.stop_event.set()
+        self.thread.join()
+        self.thread = None
+
+        # record() stops adding samples, the flush thread is not running anymore
+        with self.lock:
+            segment_fd = self.segment_fd
+            self.segment_fd = None
+
+        try:
+            self._flush(segment_fd)
+        except OSError:
+            self.logger.error('Error while writing trip to \'%s\'', self.segment_path, exc_info=1)
+
+        os.close(segment_fd)
+
+        self.logger.info('Finished recording trip to \'%s\'', self.segment_path)
+
+    def record(self, name: str, timestamp: float, value: float) -> None:
+        """
+        Adds a sample to the current batch. Does nothing if no trip is running.
+        """
+
+        with self.lock:
+            if self.segment_fd is None: return
+
+            name_id = self.name_ids.get(name)
+
+            if name_id is None:
+                name_id = self.name_ids[name] = len(self.name_ids)
+                self.names_changed = True
+
+            self.batch += record_struct.pack(name_id, timestamp, value)
+
+    def _write_names(self, name_ids: Dict[str, int]) -> None:
+
+        names_path = self.segment_path[:-len(segment_extension)] + names_extension
+
+        # write to a temporary file and rename it, so the names file is never half written
+        with open(names_path + '.tmp', 'w') as names_file:
+            json.dump(name_ids, names_file)
+            names_file.flush()
+            os.fsync(names_file.fileno())
+
+        os.replace(names_path + '.tmp', names_path)
+
+    def _flush(self, segment_fd: int) -> None:
+        """
+        Writes the batch and the names, if they changed. Only one thread may flush at a time.
+        """
+
+        # only the swap happens under the lock, the writes and fsyncs do not block record()
+        with self.lock:
+            batch, self.batch = self.batch, bytearray()
+            name_ids = dict(self.name_ids) if self.names_changed else None
+            self.names_changed = False
+
+        try:
+            # the names first, so there is never a record on disk without its name
+            if name_ids is not None: self._write_names(name_ids)
+
+            if batch:
+                os.write(segment_fd, batch)
+                os.fsync(segment_fd)
+        except OSError:
+            # try again with the next batch
+            with self.lock:
+                self.batch = batch + self.batch
+                self.names_changed = self.names_changed or name_ids is not None
+            raise
+
+    def _run(self) -> None:
+
+        while not self.stop_event.wait(self.flush_interval):
+            try:
+                self._flush(self.segment_fd)
+            except OSError:
+                self.logger.error('Error while writing trip to \'%s\'', self.segment_path, exc_info=1)
+
+
+class TripReader():
+    """
+    Reads a segment file written by TripRecorder. The file is memory-mapped, so only the records in a queried range are read.
+    """
+
+    def __init__(self, segment_path: str) -> None:
+
+        self.segment_path = segment_path
+
+        names_path = segment_path[:-len(segment_extension)] + names_extension
+
+        with open(names_path) as names_file:
+            self.names: Dict[int, str] = { name_id: name for name, name_id in json.load(names_file).items() }
+
+        self.segment_file = open(segment_path, 'rb')
+
+        size = os.fstat(self.segment_file.fileno()).st_size
+
+        # a record that was only partly written when the power was lost is ignored
+        self.count = size // record_struct.size
+
+        self.buffer = mmap.mmap(self.segment_file.fileno(), 0, access=mmap.ACCESS_READ) if self.count else b''
+
+    def close(self) -> None:
+
+        if isinstance(self.buffer, mmap.mmap):
+            self.buffer.close()
+
+        self.segment_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def timestamp_at(self, index: int) -> float:
+        return struct.unpack_from('<d', self.buffer, index * record_struct.size + 2)[0]
+
+    def find(self, timestamp: float) -> int:
+        """
+        Returns the index of the first record with a timestamp >= `timestamp`. Records are written in time order, so this is a binary search.
+        """
+
+        low, high = 0, self.count
+
+        while low < high:
+            middle = (low + high) // 2
+
+            if self.timestamp_at(middle) < timestamp:
+                low = middle + 1
+            else:
+                high = middle
+
+        return low
+
+    def range(self, start: float = float('-inf'), end: float = float('inf')) -> Iterator[Tuple[str, float, float]]:
+        """
+        Yields (name, timestamp, value) of all records with `start` <= timestamp < `end`.
+        """
+
+        first = self.find(start)
+        last = self.find(end)
+
+        for name_id, timestamp, value in record_struct.iter_unpack(self.buffer[first * record_struct.size:last * record_struct.size]):
+            yield self.names.get(name_id, str(name_id)), timestamp, value
+
+    def export_csv(self, out_file, start: float = float('-inf'), end: float = float('inf')) -> None:
+
+        writer = csv.writer(out_file)
+        writer.writerow(['name', 'timestamp', 'value'])
+        writer.writerows(self.range(start, end))
+
+
+def list_trips(directory: str) -> List[str]:
+    """
+    Returns the paths of all segment files in `directory`, oldest first.
+    """
+
+    if not os.path.isdir(directory): return []
+
+    return sorted(os.path.join(directory, name) for name in os.listdir(directory) if name.endswith(segment_extension))
+
+
+if __name__ == '__main__':
+    # export a trip as csv: python trip_recorder.py <segment file> [start timestamp] [end timestamp]
+    if len(sys.argv) < 2:
+        print('usage: python trip_recorder.py <segment file> [start timestamp] [end timestamp]')
+        sys.exit(1)
+
+    start = float(sys.argv[2]) if len(sys.argv) > 2 else float('-inf')
+    end = float(sys.argv[3]) if len(sys.argv) > 3 else float('inf')
+
+    with TripReader(sys.argv[1]) as reader:
+        reader.export_csv(sys.stdout, start, end)
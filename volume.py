@@ -0,0 +1,143 @@
+import re
+import logging
+import subprocess
+from time import sleep
+from threading import Thread, Lock, Event
+
+
+class VolumeController():
+    """
+    Sets the volume of a mixer control through one long-lived `amixer -s` process, which reads commands from stdin.
+
+    set() only stores the wanted volume, a background thread sends the latest one at most every `min_interval` seconds.
+    Dragging a volume slider therefore sends a few commands instead of one process per step.
+    The volume is cached, reading it does not query the mixer.
+    """
+
+    def __init__(self, amixer_path: str = 'amixer', control: str = 'Master', min_interval: float = 0.05, logger: logging.Logger = None) -> None:
+        """
+        :param amixer_path: The path/name of the `amixer` program.
+        :param control: The mixer control that is changed.
+        :param min_interval: Minimum seconds between two commands sent to `amixer`.
+        """
+
+        # if logger is set, use it
+        # if logger is not set a null_logger is created that wont log anything
+        if logger:
+            self.logger = logger
+        else:
+            # create a logger
+            self.logger = logging.getLogger('null_logger')
+
+            # create a NullHandler and add it to the logger
+            null_handler = logging.NullHandler()
+            self.logger.addHandler(null_handler)
+
+            # set the logger level to NOTSET to capture all messages
+            self.logger.setLevel(logging.NOTSET)
+
+        self.amixer_path = amixer_path
+        self.control = control
+        self.min_interval = min_interval
+
+        self.process: subprocess.Popen = None
+
+        self.lock = Lock()
+
+        self.volume: float = None
+        """The last volume that was set or read (0 to 1). None until it is known."""
+
+        # the mixer is asked only once, also when that failed
+        self.read_attempted = False
+
+        self.pending_volume: float = None
+        self.pending_event = Event()
+
+        self.thread = Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def get(self, default: float = 0.5) -> float:
+        """
+        Returns the cached volume. The mixer is only asked once, when the volume was not set before.
+        If it could not be read, `default` is returned until the volume is set.
+        """
+
+        if self.volume is None and not self.read_attempted:
+            self.read_attempted = True
+            self.volume = self.read()
+
+        return self.volume if self.volume is not None else default
+
+    def read(self) -> float:
+        """
+        Asks `amixer` for the current volume of the control. Returns None if it can not be read.
+        """
+
+        try:
+            out = subprocess.run([self.amixer_path, 'sget', self.control], capture_output=True, universal_newlines=True).stdout
+        except FileNotFoundError:
+            self.logger.error('The mixer utility was not found: `%s`', self.amixer_path)
+            return None
+
+        # e.g. '  Front Left: Playback 45875 [70%] [on]'
+        match = re.search(r'\[(\d+)%\]', out)
+
+        return int(match.group(1)) / 100 if match else None
+
+    def set(self, volume: float) -> None:
+        """
+        Sets the volume (0 to 1). It is sent to the mixer in the background, only the latest of quick consecutive calls is sent.
+        """
+
+        with self.lock:
+            self.volume = volume
+            self.pending_volume = volume
+
+        self.pending_event.set()
+
+    def close(self) -> None:
+
+        if self.process and self.process.poll() is None:
+            self.process.stdin.close()
+            self.process.wait(timeout=1)
+
+        self.process = None
+
+    def _send(self, volume: float) -> None:
+
+        if not self.process or self.process.poll() is not None:
+            self.logger.info('Starting amixer session: \'%s\'', self.amixer_path)
+
+            # the answers of amixer are not needed, a full stdout pipe would block it
+            self.process = subprocess.Popen(
+                [self.amixer_path, '-s'],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                universal_newlines=True,
+            )
+
+        self.process.stdin.write(f'sset {self.control} {round(volume * 100)}%\n')
+        self.process.stdin.flush()
+
+    def _run(self) -> None:
+
+        while True:
+            self.pending_event.wait()
+
+            with self.lock:
+                volume = self.pending_volume
+                self.pending_volume = None
+                self.pending_event.clear()
+
+            if volume is None: continue
+
+            try:
+                self._send(volume)
+            except (OSError, ValueError):
+                self.logger.error('Error while setting volume with amixer.', exc_info=1)
+                self.process = None
+
+            # calls in the meantime are collapsed into the latest value
+            sleep(self.min_interval)